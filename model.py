@@ -3,24 +3,33 @@
 @brief: main
 """
 
+import hashlib
 import igraph
-import math
 import nltk
 import numpy as np
+import os
 import pandas as pd
+import pickle
 import random
 import re
 import time
 import xgboost as xgb
 
+from collections import OrderedDict
+from functools import lru_cache
+
 from matplotlib import pyplot as plt
 from sklearn import preprocessing
-from sklearn.cross_validation import KFold
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, ExtraTreesRegressor
 from sklearn.linear_model import LogisticRegression
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import KFold, cross_val_predict, train_test_split
 from sklearn.metrics import f1_score, accuracy_score
-from utils import dist_utils
+from utils import bundle_utils, candidate_utils, centrality_utils, dist_utils, feature_utils, graph_utils, \
+    index_utils, ngram_utils, model_utils, parallel_utils, sketch_utils, snapshot_utils, text_utils, tfidf_utils, \
+    tuning_utils
+from utils.feature_utils import FeatureStore
+from utils.node_utils import NodeStore
 from xgboost import plot_importance
 
 nltk.download('punkt')  # for tokenization
@@ -31,23 +40,137 @@ DIR_TRIAN = "social_train.txt"
 DIR_TEST = "social_test.txt"
 DIR_NODEINFO = "node_information.csv"
 PREDICT = "randomprediction.csv"
+DIR_CANDIDATES = "candidates.txt"  # "id_source id_target" per line, scored by STREAM_SCORING
+STREAM_OUTPUT = "candidate_prediction"
+DIR_QUERIES = "queries.txt"  # one paper id per line, recommended for by RECOMMEND
+RECOMMEND_OUTPUT = "recommendation"
+FEATURE_DIR = "features"
+SNAPSHOT_DIR = "snapshot"
+ENSEMBLE_DIR = "ensemble"
+BUNDLE_DIR = "bundle"
+TUNING_DIR = "tuning"
+SNAPSHOT_VERSION = 1  # bump whenever prepare_data or the graph builders change what they produce
 
 
 # ------- Control -------
-RUN_FOR_FIRST_TIME = True
+FORCE_RECOMPUTE = False  # recompute every feature family instead of reusing the feature store
 SUBMIT = False
 LOAD_SAMPLE = False
 TUNING = False
 TUNING_PARMS = "max_depth & min_child_weight"
+TUNING_RESOURCE = "rounds"  # budget successive halving grows for the best points: boosting "rounds" or training "rows"
+TUNING_ETA = 3  # every rung keeps the best 1 / TUNING_ETA of the points on TUNING_ETA times the budget
+TUNING_MIN_FRACTION = 1.0 / 9  # budget share of the first rung
 ENSEMBLE = False
+SAVE_BUNDLE = False  # save the trained model(s) with their feature selection, scaling and threshold to BUNDLE_DIR
+N_JOBS = -1  # processes for feature extraction, -1 means all cores
+GRAPH_FOLDS = 5  # graph features of training pairs come from graphs without their own fold, 1 uses the full graph
+GRAPH_FOLD_SEED = 7
+STEM_CACHE_SIZE = 1 << 20  # distinct words whose stem is memoized
+HUB_DEGREE = 200  # papers cited at least this often share their neighbourhood across pairs in network features
+STREAM_SCORING = False  # after training, score DIR_CANDIDATES in chunks instead of loading it at once
+STREAM_CHUNK_SIZE = 1000000  # pairs per chunk of the streaming scorer
+RECOMMEND = False  # after training, recommend the TOP_K papers every paper of DIR_QUERIES most likely cites
+TOP_K = 10
+CANDIDATES_PER_SOURCE = 100  # candidates a query paper draws at most from each candidate source
+MINHASH_PERM = 128  # MinHash signature length, more permutations estimate jaccard closer but slower
+LSH_MAX_BUCKET_SIZE = 100  # papers of one LSH bucket paired at most, larger buckets are subsampled
+EARLY_STOPPING_ROUNDS = 20  # boosting stops when a held-out part of the training set stalls this long, 0 never
+MAX_BOOST_ROUNDS = 1000  # boosting rounds of the single model and the ensemble base models when early stopping
+VALID_SIZE = 0.1  # held-out share of the training rows for early stopping and threshold tuning
+TFIDF_SVD_COMPONENTS = 0  # > 0: tfidf_cosine on dense truncated-SVD vectors of this size instead of sparse tf-idf
 # -----------------------
 
+# tokenized columns kept in the node store
+TOKEN_FIELDS = ["tkzd_title", "tkzd_title_rm_stpwds", "tkzd_title_rm_stpwds_stem",
+                "tkzd_abstract", "tkzd_abstract_rm_stpwds", "tkzd_abstract_rm_stpwds_stem"]
+
+# feature families in the column order of the feature matrix (columns 0 - 48)
+FEATURE_FAMILIES = [
+    ("node", ["jaccard_tkzd_title",  # 0
+              "dice_tkzd_title",  # 1
+              "jaccard_tkzd_abstract",  # 2
+              "jaccard_bigr_tkzd_abstract",  # 3
+              "jaccard_trigr_tkzd_abstract",  # 4
+              "dice_tkzd_abstract",  # 5
+              "dice_bigr_tkzd_abstract",  # 6
+              "dice_trigr_tkzd_abstract",  # 7
+              "jaccard_tkzd_abstract_rm_stpwds",  # 8
+              "jaccard_bigr_tkzd_abstract_rm_stpwds",  # 9
+              "jaccard_trigr_tkzd_abstract_rm_stpwds",  # 10
+              "dice_tkzd_abstract_rm_stpwds",  # 11
+              "dice_bigr_tkzd_abstract_rm_stpwds",  # 12
+              "dice_trigr_tkzd_abstract_rm_stpwds"]),  # 13
+    ("pagerank_paper", ["pagerank_paper_from",  # 14
+                        "pagerank_paper_to",  # 15
+                        "pagerank_paper_max"]),  # 16
+    ("mean_aciteb", ["meanAciteB",  # 17
+                     "maxAciteB",  # 18
+                     "sumAciteB",  # 19
+                     "meanBciteA",  # 20
+                     "maxBciteA",  # 21
+                     "sumBciteA",  # 22
+                     "maxmeancite",  # 23
+                     "maxmaxcite",  # 24
+                     "maxsumcite",  # 25
+                     "meanAciteB_all",  # 26
+                     "maxAciteB_all",  # 27
+                     "sumAciteB_all"]),  # 28
+    ("pagerank_author", ["author_pagerank_mean_from",  # 29
+                         "author_pagerank_mean_to",  # 30
+                         "author_pagerank_max_from",  # 31
+                         "author_pagerank_max_to",  # 32
+                         "author_pagerank_max_max"]),  # 33
+    ("adamic_adar_paper", ["adamic_adar_paper"]),  # 34
+    ("dyear", ["dyear"]),  # 35
+    ("author_overlap", ["author_overlap"]),  # 36
+    ("network", ["network_from_mean",  # 37
+                 "network_from_sum",  # 38
+                 "network_to_mean",  # 39
+                 "network_to_sum",  # 40
+                 "network_to_mean_max",  # 41
+                 "network_to_sum_max"]),  # 42
+    ("link_scores_paper", ["common_neighbours_paper",  # 43
+                           "resource_allocation_paper",  # 44
+                           "preferential_attachment_paper",  # 45
+                           "jaccard_neighbours_paper"]),  # 46
+    ("tfidf_cosine", ["tfidf_cosine_title",  # 47
+                      "tfidf_cosine_abstract"]),  # 48
+]
+
+# bump a family's version whenever its code changes, cached features of older versions are recomputed
+FEATURE_VERSIONS = {"node": 1, "pagerank_paper": 1, "mean_aciteb": 3, "pagerank_author": 1,
+                    "adamic_adar_paper": 2, "dyear": 1, "author_overlap": 1, "network": 2, "link_scores_paper": 1,
+                    "tfidf_cosine": 1}
+# families computed on the graphs built from the positive training pairs
+GRAPH_FAMILIES = {"pagerank_paper", "mean_aciteb", "pagerank_author", "adamic_adar_paper", "network",
+                  "link_scores_paper"}
+
+# columns of the feature matrix the models are trained on (select important features)
+SELECTED_FEATURES = [0, 2, 3, 8, 9, 14, 15, 16, 17, 18, 20, 21, 23, 24, 26, 29, 30, 31, 33, 34, 35, 37, 38, 39, 40,
+                     41, 42]
+
+# abstract n-grams shared with a query paper that make a candidate, those with an idf below CANDIDATE_MIN_IDF
+# (in more than 1% of the papers) are too common to tell anything
+CANDIDATE_NGRAM = ("tkzd_abstract_rm_stpwds", 2)
+CANDIDATE_MIN_IDF = np.log(100)
+
+# token fields of the tfidf_cosine family, in its column order
+TFIDF_FIELDS = ["tkzd_title_rm_stpwds_stem", "tkzd_abstract_rm_stpwds_stem"]
+
+# n-gram orders used by the node features, in the column order of `get_features`
+NGRAM_FIELDS = [("tkzd_title", (1,)),
+                ("tkzd_abstract", (1, 2, 3)),
+                ("tkzd_abstract_rm_stpwds", (1, 2, 3))]
+
 
 class Data():
     def __init__(self, sample):
 
         assert type(sample) == bool
         self.stemmer = nltk.stem.PorterStemmer()
+        self.stem = lru_cache(maxsize=STEM_CACHE_SIZE)(self.stemmer.stem)  # stem every distinct word once
+        self.prepare_timings = OrderedDict()
         # the columns of the node data frame below are:
         # (0) paper unique ID (integer)
         # (1) publication year (integer)
@@ -59,26 +182,39 @@ class Data():
         self.data_trian = None
         self.data_train_positive = None
         self.data_test = None
+        self.data_stream = None
         self.data_node_info = None
 
-        self.node_dict = None
+        self.node_store = None
+        self.ngram_matrices = None
+        # inverted indexes and MinHash signatures of the token fields, see `get_text_index` and `get_minhash`
+        self.text_indexes = {}
+        self.minhash = {}
+        # tf-idf vectors of TFIDF_FIELDS, see `init_tfidf_vectors`
+        self.tfidf_vectors = None
+
+        # centralities of the current graphs, base_* those of the full graphs (kept across masking)
+        self.base_centrality_paper = None
+        self.centrality_paper = None
+        self.base_centrality_author = None
+        self.centrality_author = None
 
         # graph
         self.graph_paper = igraph.Graph(directed=True)
         self.id_graphid_paper = {}
+        # sparse views of graph_paper for batch link scores, base_* always hold the full graphs
+        self.base_adjacency_paper = None
+        self.adjacency_paper = None
+        self.neighbours_paper = None
+        self.degree_paper = None
+        self.out_paper = None
+        self.in_paper = None
         self.graph_author = igraph.Graph(directed=True)
         self.id_graphid_author = {}
-
-    def AciteB(self, edge):
-        neighbors = self.graph_author.neighbors(self.graph_author.vs[edge[0]], mode="OUT")  # get citaion of from_author
-        length = neighbors.count(edge[1])  # how many times did from_author cite to_author
-        return (length)
-
-    def AciteB_all(self, edge):
-        neighbors = self.graph_author.neighbors(self.graph_author.vs[edge[0]],
-                                                mode="ALL")  # get neighbots of from_author
-        length = neighbors.count(edge[1])  # how many times did from_author cite to_author
-        return (length)
+        self.base_citation_author = None
+        self.citation_author = None
+        # sparse factors of the candidate sources of `get_candidates`
+        self.candidate_sources = None
 
     def add_position(self, data):
         assert type(data) == list
@@ -89,184 +225,172 @@ class Data():
             ids.append(element[0])
         return position
 
-    def apply_pagerank(self, input_list, pageranktype):
-        # input_list: e.g. [(123,456), (234,252)]
-        if type(input_list) == list:
-            if pageranktype == "mean_from":
-                author_pagerank_from = list(map(self.lookup_author_pagerank_from, input_list))
-                return np.mean(author_pagerank_from)
-            elif pageranktype == "mean_to":
-                author_pagerank_from = list(map(self.lookup_author_pagerank_to, input_list))
-                return np.mean(author_pagerank_from)
-            elif pageranktype == "max_from":
-                author_pagerank_from = list(map(self.lookup_author_pagerank_from, input_list))
-                return np.max(author_pagerank_from)
-            elif pageranktype == "max_to":
-                author_pagerank_from = list(map(self.lookup_author_pagerank_to, input_list))
-                return np.max(author_pagerank_from)
-        else:
-            return 0
-
-    def author_citation_edge(self, ids):
-        citation_list = []
-        graphids = self.get_direct(ids, return_type="id")
-        from_authors = self.node_dict[graphids[0]]['tkzd_author']
-        to_authors = self.node_dict[graphids[1]]['tkzd_author']
-        if type(from_authors) == list and type(to_authors) == list:
-            for from_a in from_authors:
-                for to_a in to_authors:
-                    if from_a != '' and to_a != '':
-                        citation_list.append((self.id_graphid_author[from_a], self.id_graphid_author[to_a]))
-            return citation_list
-        else:
-            return np.nan
-
-    def BciteA(self, edge):
-        neighbors = self.graph_author.neighbors(self.graph_author.vs[edge[1]], mode="OUT")  # get citaion of to_author
-        length = neighbors.count(edge[1])  # how many times did to_author cite  rom_author
-        return (length)
-
     def get_authors_list(self):
-        authors_list = []
-
-        for key, value in self.node_dict.items():
-            if type(value['tkzd_author']) == list:
-                authors_list.extend(value['tkzd_author'])
+        # distinct authors, in the order of their ids in the node store
+        return list(self.node_store.authors.names)
 
-        authors_list = list(set(authors_list))
-        authors_list.remove('')
-        return authors_list
-
-    def get_author_overlap(self, ids):
-        from_author = self.node_dict[ids[0]]["tkzd_author"]
-        to_author = self.node_dict[ids[1]]["tkzd_author"]
-        if (type(from_author) == list) and (type(to_author) == list):
-            return len(set(from_author).intersection(set(to_author)))
-        else:
-            return 0
+    def get_author_pairs(self, batch_data):
+        # (row position, from author, to author) for the cartesian product of the authors of every
+        # (from paper, to paper) row of batch_data; author ids are the vertex ids of self.graph_author
+        graphid_from, graphid_to = self.lookup_graph_ids(batch_data)
+        authors = self.node_store.authors
+        return graph_utils._cartesian_pairs(authors.values, authors.offsets, graphid_from, graphid_to)
 
-    def get_batch(self, from_iloc, to_iloc, data_set, get_item):
+    def get_batch(self, from_iloc, to_iloc, data_set, get_item, rows=None):
         # ids from self.data_train
-        if data_set == "train":
-            batch_data = self.data_train.iloc[from_iloc: to_iloc]
-        elif data_set == "test":
-            batch_data = self.data_test.iloc[from_iloc: to_iloc]
+        # rows: positions to take instead of from_iloc: to_iloc
+        if rows is None:
+            rows = slice(from_iloc, to_iloc)
+        batch_data = self.get_data(data_set).iloc[rows]
         if get_item == "node":
             print("getting node features")
-            features_node = batch_data[["id_source", "id_target"]].apply(self.get_features, axis=1)
+            features_node = self.get_features_batch(batch_data)
             return features_node
         elif get_item == "network_jaccard_from":
             print("getting network features")
-            network_from = batch_data[["id_source", "id_target"]].apply(self.get_graph_simi, args=("from",), axis=1)
-            features_network_from_mean = network_from.apply(lambda x: x[0], axis=1)
-            features_network_from_sum = network_from.apply(lambda x: x[1], axis=1)
-            features_network_from = pd.concat([features_network_from_mean, features_network_from_sum], axis=1)
+            features_network_from = self.get_graph_simi(batch_data, "from")
             return features_network_from
         elif get_item == "network_jaccard_to":
             print("getting network features")
-            network_to = batch_data[["id_source", "id_target"]].apply(self.get_graph_simi, args=("to",), axis=1)
-            features_network_to_mean = network_to.apply(lambda x: x[0], axis=1)
-            features_network_to_sum = network_to.apply(lambda x: x[1], axis=1)
-            features_network_to = pd.concat([features_network_to_mean, features_network_to_sum], axis=1)
+            features_network_to = self.get_graph_simi(batch_data, "to")
             return features_network_to
         elif get_item == "pagerank_paper":
-            self.pagerank_paper = self.graph_paper.pagerank()
-            features_pagerank_from = batch_data[["id_source", "id_target"]].apply(self.get_pagerank, args=("from",),
-                                                                                  axis=1)
-            features_pagerank_to = batch_data[["id_source", "id_target"]].apply(self.get_pagerank, args=("to",), axis=1)
-            features_pagerank_paper = pd.concat([features_pagerank_from, features_pagerank_to], axis=1)
-            return features_pagerank_paper
+            # pagerank of the from and the to paper
+            graphid_from, graphid_to = self.lookup_graph_ids(batch_data)
+            features_pagerank_paper = self.centrality_paper.pair_features(["pagerank"], graphid_from, graphid_to)
+            return pd.DataFrame(features_pagerank_paper, index=batch_data.index)
         elif get_item == "mean_aciteb":
-            if data_set == "train":
-                modified_data = pd.concat([pd.DataFrame([{"id_source": 201080, "id_target": 9905149}]),
-                                           batch_data[["id_source", "id_target"]]])  # TODO: need automation
-            elif data_set == "test":
-                modified_data = pd.concat([pd.DataFrame([{"id_source": 9912290, "id_target": 7120}]),
-                                           batch_data[["id_source", "id_target"]]])  # TODO: need automation
-            citation_edges = modified_data.apply(self.author_citation_edge, axis=1)
-            citation_edges = citation_edges.iloc[1:]
-
-            features_AciteB = citation_edges.apply(self.meanAciteB)
-            features_meanAciteB = features_AciteB.apply(lambda x: x[0])
-            features_maxAciteB = features_AciteB.apply(lambda x: x[1])
-            features_sumAciteB = features_AciteB.apply(lambda x: x[2])
-
-            features_BciteA = citation_edges.apply(self.meanBciteA)
-            features_meanBciteA = features_BciteA.apply(lambda x: x[0])
-            features_maxBciteA = features_BciteA.apply(lambda x: x[1])
-            features_sumBciteA = features_BciteA.apply(lambda x: x[2])
-
-            features_AciteB_all = citation_edges.apply(self.meanAciteB, args=("all",))
-            features_meanAciteB_all = features_AciteB_all.apply(lambda x: x[0])
-            features_maxAciteB_all = features_AciteB_all.apply(lambda x: x[1])
-            features_sumAciteB_all = features_AciteB_all.apply(lambda x: x[2])
-
-            if data_set == "train":
-                features_meanAciteB[batch_data["predict"] == 1] -= 1
-                features_meanAciteB[features_meanAciteB == -1] = 0
-                features_meanBciteA[batch_data["predict"] == 1] -= 1
-                features_meanBciteA[features_meanBciteA == -1] = 0
-
-                features_maxAciteB[batch_data["predict"] == 1] -= 1
-                features_maxAciteB[features_maxAciteB == -1] = 0
-                features_maxBciteA[batch_data["predict"] == 1] -= 1
-                features_maxBciteA[features_maxBciteA == -1] = 0
-
-                features_meanAciteB_all[batch_data["predict"] == 1] -= 1
-                features_meanAciteB_all[features_meanAciteB_all == -1] = 0
-                features_maxAciteB_all[batch_data["predict"] == 1] -= 1
-                features_maxAciteB_all[features_maxAciteB_all == -1] = 0
-
-                features_maxmeancite = np.max(pd.concat([features_meanAciteB, features_meanBciteA], axis=1), axis=1)
-                features_maxmaxcite = np.max(pd.concat([features_maxAciteB, features_maxBciteA], axis=1), axis=1)
-                features_maxsumcite = np.max(pd.concat([features_sumAciteB, features_sumBciteA], axis=1), axis=1)
-
-                return pd.concat([features_meanAciteB, features_maxAciteB, features_sumAciteB, features_meanBciteA,
-                                  features_maxBciteA, features_sumBciteA, features_maxmeancite, features_maxmaxcite,
-                                  features_maxsumcite, features_meanAciteB_all, features_maxAciteB_all,
-                                  features_sumAciteB_all], axis=1)
-            elif data_set == "test":
-
-                features_maxmeancite = np.max(pd.concat([features_meanAciteB, features_meanBciteA], axis=1), axis=1)
-                features_maxmaxcite = np.max(pd.concat([features_maxAciteB, features_maxBciteA], axis=1), axis=1)
-                features_maxsumcite = np.max(pd.concat([features_sumAciteB, features_sumBciteA], axis=1), axis=1)
-
-                return pd.concat([features_meanAciteB, features_maxAciteB, features_sumAciteB, features_meanBciteA,
-                                  features_maxBciteA, features_sumBciteA, features_maxmeancite, features_maxmaxcite,
-                                  features_maxsumcite, features_meanAciteB_all, features_maxAciteB_all,
-                                  features_sumAciteB_all], axis=1)
-
-
+            # mean, max and sum of author citation counts over all (from author, to author) pairs
+            positions, from_authors, to_authors = self.get_author_pairs(batch_data)
+            n_rows = batch_data.shape[0]
+            acitebs = graph_utils._gather(self.citation_author, from_authors, to_authors)
+            bciteas = graph_utils._gather(self.citation_author, to_authors, from_authors)
+            features_meanAciteB, features_maxAciteB, features_sumAciteB = graph_utils._group_stats(
+                positions, acitebs, n_rows)
+            features_meanBciteA, features_maxBciteA, features_sumBciteA = graph_utils._group_stats(
+                positions, bciteas, n_rows)
+            features_meanAciteB_all, features_maxAciteB_all, features_sumAciteB_all = graph_utils._group_stats(
+                positions, acitebs + bciteas, n_rows)
+
+            # a pair's own edge, if it is in the graph, adds one citation from every from author to every to author
+            graphid_from, graphid_to = self.lookup_graph_ids(batch_data)
+            own_edge = graph_utils._gather(self.adjacency_paper, graphid_from, graphid_to)
+            features_meanAciteB = np.maximum(features_meanAciteB - own_edge, 0)
+            features_maxAciteB = np.maximum(features_maxAciteB - own_edge, 0)
+            features_meanAciteB_all = np.maximum(features_meanAciteB_all - own_edge, 0)
+            features_maxAciteB_all = np.maximum(features_maxAciteB_all - own_edge, 0)
+
+            features_maxmeancite = np.maximum(features_meanAciteB, features_meanBciteA)
+            features_maxmaxcite = np.maximum(features_maxAciteB, features_maxBciteA)
+            features_maxsumcite = np.maximum(features_sumAciteB, features_sumBciteA)
+
+            return pd.DataFrame(np.column_stack([features_meanAciteB, features_maxAciteB, features_sumAciteB,
+                                                 features_meanBciteA, features_maxBciteA, features_sumBciteA,
+                                                 features_maxmeancite, features_maxmaxcite, features_maxsumcite,
+                                                 features_meanAciteB_all, features_maxAciteB_all,
+                                                 features_sumAciteB_all]), index=batch_data.index)
         elif get_item == "pagerank_author":
-            self.pagerank_author = self.graph_author.pagerank()  # ids are vertice ids in graph_author
-            if data_set == "train":
-                modified_data = pd.concat([pd.DataFrame([{"id_source": 201080, "id_target": 9905149}]),
-                                           batch_data[["id_source", "id_target"]]])  # TODO: need automation
-            elif data_set == "test":
-                modified_data = pd.concat([pd.DataFrame([{"id_source": 9912290, "id_target": 7120}]),
-                                           batch_data[["id_source", "id_target"]]])  # TODO: need automation
-            citation_edges = modified_data.apply(self.author_citation_edge, axis=1)
-            citation_edges = citation_edges.iloc[1:]
-
-            features_author_pagerank_mean_from = citation_edges.apply(self.apply_pagerank, args=("mean_from",))
-            features_author_pagerank_mean_to = citation_edges.apply(self.apply_pagerank, args=("mean_to",))
-            features_author_pagerank_max_from = citation_edges.apply(self.apply_pagerank, args=("max_from",))
-            features_author_pagerank_max_to = citation_edges.apply(self.apply_pagerank, args=("max_to",))
-
-            features_pagerank_author = pd.concat([features_author_pagerank_mean_from, features_author_pagerank_mean_to,
-                                                  features_author_pagerank_max_from, features_author_pagerank_max_to],
-                                                 axis=1)
-            return features_pagerank_author
+            # mean and max pagerank of the from authors and of the to authors
+            positions, from_authors, to_authors = self.get_author_pairs(batch_data)
+            features_pagerank_author = self.centrality_author.group_features(["pagerank"], positions, from_authors,
+                                                                             to_authors, batch_data.shape[0])
+            return pd.DataFrame(features_pagerank_author, index=batch_data.index)
         elif get_item == "adamic_adar_paper":
-            features_adamic_adar_paper = batch_data[["id_source", "id_target"]].apply(self.similarity,
-                                                                                      args=(self.graph_paper,), axis=1)
+            scores = self.get_link_scores(batch_data)
+            features_adamic_adar_paper = pd.Series(scores["adamic_adar"], index=batch_data.index)
             return features_adamic_adar_paper
+        elif get_item == "link_scores_paper":
+            scores = self.get_link_scores(batch_data)
+            features_link_scores_paper = pd.DataFrame(
+                np.column_stack([scores["common_neighbours"], scores["resource_allocation"],
+                                 scores["preferential_attachment"], scores["jaccard"]]), index=batch_data.index)
+            return features_link_scores_paper
         elif get_item == "dyear":
-            features_dyear = batch_data[["id_source", "id_target"]].apply(self.get_year, axis=1)
+            # same as `get_year` for every row
+            years_source = self.node_store.years[self.node_store.rows(batch_data["id_source"].values)]
+            years_target = self.node_store.years[self.node_store.rows(batch_data["id_target"].values)]
+            features_dyear = pd.Series(np.maximum(years_source - years_target, 0), index=batch_data.index)
             return features_dyear
         elif get_item == "author_overlap":
-            features_author_overlap = batch_data[["id_source", "id_target"]].apply(self.get_author_overlap, axis=1)
+            # number of shared authors, the authors of a paper are distinct
+            positions, from_authors, to_authors = self.get_author_pairs(batch_data)
+            features_author_overlap = pd.Series(np.bincount(positions[from_authors == to_authors],
+                                                            minlength=batch_data.shape[0]), index=batch_data.index)
             return features_author_overlap
+        elif get_item == "tfidf_cosine":
+            # cosine of the tf-idf vectors of the title and of the abstract
+            if self.tfidf_vectors is None:
+                self.init_tfidf_vectors()
+            rows_source = self.node_store.rows(batch_data["id_source"].values)
+            rows_target = self.node_store.rows(batch_data["id_target"].values)
+            features_tfidf_cosine = pd.DataFrame(
+                np.column_stack([tfidf_utils._batch_cosine(self.tfidf_vectors[field], rows_source, rows_target)
+                                 for field in TFIDF_FIELDS]), index=batch_data.index)
+            return features_tfidf_cosine
+
+    def get_batch_parallel(self, data_set, get_item, rows=None, n_jobs=N_JOBS, chunk_size=None):
+        # `get_batch` over all rows (or the positions `rows`) of data_set, sharded across forked workers
+        # that share self copy-on-write
+        if rows is None:
+            rows = np.arange(self.get_data(data_set).shape[0])
+        n_rows = len(rows)
+        if n_rows == 0:
+            # nothing to shard, and pd.concat has no chunk to concatenate: an empty frame as wide as get_batch's
+            return pd.DataFrame(np.zeros((0, self.get_batch_width(get_item))),
+                                index=self.get_data(data_set).index[rows])
+        n_jobs = parallel_utils._n_jobs(n_jobs)
+        if chunk_size is None:
+            chunk_size = -(-n_rows // (n_jobs * 4))
+
+        # state that `get_batch` would build lazily is built once here, before forking
+        if self.ngram_matrices is None and get_item == "node":
+            self.init_ngram_matrices()
+        if self.tfidf_vectors is None and get_item == "tfidf_cosine":
+            self.init_tfidf_vectors()
+        if get_item == "pagerank_paper":
+            self.centrality_paper.compute(["pagerank"])
+        if get_item == "pagerank_author":
+            self.centrality_author.compute(["pagerank"])
+
+        args_list = [(0, 0, data_set, get_item, rows[from_iloc: to_iloc])
+                     for from_iloc, to_iloc in parallel_utils._chunk_bounds(n_rows, chunk_size)]
+        features = parallel_utils._map_shared(self, "get_batch", args_list, n_jobs=n_jobs)
+        return pd.concat(features, axis=0)
+
+    def get_batch_width(self, get_item):
+        # number of columns `get_batch` returns for get_item: the columns of its family in FEATURE_FAMILIES but
+        # the ones `get_family` adds, the maxima of the two pageranks and of the two network halves
+        if get_item in ("network_jaccard_from", "network_jaccard_to"):
+            return 2
+        width = len(dict(FEATURE_FAMILIES)[get_item])
+        return width - 1 if get_item in ("pagerank_paper", "pagerank_author") else width
+
+    def get_candidates(self, query_ids, max_candidates=CANDIDATES_PER_SOURCE):
+        # (id_source, id_target) candidate pairs of every query paper, drawn from bounded sources instead of all
+        # papers: the max_candidates papers sharing the most authors, the most common neighbours in graph_paper
+        # (two hops) and the most rare abstract n-grams. The query itself and its neighbours are left out
+        if self.candidate_sources is None:
+            self.init_candidate_sources()
+        queries = self.node_store.rows(query_ids)
+        positions = []
+        candidates = []
+        for left, right in self.candidate_sources:
+            source_positions, source_candidates, _ = candidate_utils._top_candidates(
+                left, right, queries, max_candidates, exclude=self.neighbours_paper)
+            positions.append(source_positions)
+            candidates.append(source_candidates)
+        pairs = np.unique(np.column_stack([np.concatenate(positions), np.concatenate(candidates)]), axis=0)
+        return pd.DataFrame({"id_source": self.node_store.ids[queries[pairs[:, 0]]],
+                             "id_target": self.node_store.ids[pairs[:, 1]]})
+
+    def get_data(self, data_set):
+        # pairs of a data set: "train", "test" or "stream" (the current chunk of `score_stream`)
+        if data_set == "train":
+            return self.data_train
+        elif data_set == "test":
+            return self.data_test
+        elif data_set == "stream":
+            return self.data_stream
 
     def get_direct(self, ids, return_type="graph_id"):
         # need self.id_graphid
@@ -274,8 +398,8 @@ class Data():
         # output: tuple: (from_graph_id, to_graph_id) or (from_id, to_id)
         # year(from_id) >= year(to_id)
 
-        year_id1 = self.node_dict[ids[0]]["year"]
-        year_id2 = self.node_dict[ids[1]]["year"]
+        year_id1 = self.node_store.years[self.node_store.row[ids[0]]]
+        year_id2 = self.node_store.years[self.node_store.row[ids[1]]]
         if return_type == "graph_id":
             if year_id1 >= year_id2:  # TODO: how to deal with papers in same year, I ignore it now
                 return (self.id_graphid_paper[ids[0]], self.id_graphid_paper[ids[1]])
@@ -287,115 +411,243 @@ class Data():
             else:
                 return (ids[1], ids[0])
 
+    def get_families_oof(self, family_rows):
+        # `get_family_oof` of every (family, rows) of family_rows, {family: features}; every fold is masked once
+        # and all families are computed on it
+        folds = graph_utils._pair_folds(self.data_train["id_source"].values, self.data_train["id_target"].values,
+                                        GRAPH_FOLDS, seed=GRAPH_FOLD_SEED)
+        family_rows = [(family, np.arange(self.data_train.shape[0]) if rows is None else rows)
+                       for family, rows in family_rows]
+        features = {family: [] for family, _ in family_rows}
+        for k in range(GRAPH_FOLDS):
+            fold_rows = [(family, rows[folds[rows] == k]) for family, rows in family_rows]
+            if not any(len(rows) for _, rows in fold_rows):
+                continue
+            self.mask_graphs(self.data_train[folds == k])
+            for family, rows in fold_rows:
+                if len(rows):
+                    features[family].append(self.get_family("train", family, rows=rows, out_of_fold=False))
+        self.mask_graphs()
+        return {family: pd.concat(features[family], axis=0).loc[self.data_train.index[rows]]
+                for family, rows in family_rows}
+
+    def get_family(self, data_set, family, rows=None, out_of_fold=GRAPH_FOLDS > 1, n_jobs=N_JOBS):
+        # all columns of one family of FEATURE_FAMILIES, for all rows (or the positions `rows`) of data_set
+        if out_of_fold and data_set == "train" and family in GRAPH_FAMILIES:
+            return self.get_family_oof(family, rows=rows)
+        if family == "network":
+            features_network_from = self.get_batch_parallel(data_set, get_item="network_jaccard_from", rows=rows,
+                                                            n_jobs=n_jobs)
+            features_network_to = self.get_batch_parallel(data_set, get_item="network_jaccard_to", rows=rows,
+                                                          n_jobs=n_jobs)
+            return pd.concat([features_network_from, features_network_to, np.max(
+                pd.concat([features_network_from.iloc[:, 0], features_network_to.iloc[:, 0]], axis=1), axis=1), np.max(
+                pd.concat([features_network_from.iloc[:, 1], features_network_to.iloc[:, 1]], axis=1), axis=1)], axis=1)
+        features = self.get_batch_parallel(data_set, get_item=family, rows=rows, n_jobs=n_jobs)
+        if family in ("pagerank_paper", "pagerank_author"):
+            features = pd.concat([features, np.max(features, axis=1)], axis=1)
+        return features
+
+    def get_family_oof(self, family, rows=None):
+        # graph features of training rows, each computed on the graphs without the positive pairs of its own fold
+        return self.get_families_oof([(family, rows)])[family]
+
+    def get_feature_key(self, family):
+        # cache key of a feature family: its code version and the content of everything it is computed from
+        md5 = hashlib.md5()
+        md5.update(("%s %d " % (family, FEATURE_VERSIONS[family])).encode())
+        md5.update(feature_utils._file_md5(DIR_NODEINFO).encode())
+        if family in GRAPH_FAMILIES:
+            # the graphs are built from the (sampled) positive training pairs, in any order
+            edges = self.data_train_positive[["id_source", "id_target"]].values.astype(np.int64)
+            edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+            md5.update(np.ascontiguousarray(edges).tobytes())
+            md5.update(("folds %d %d" % (GRAPH_FOLDS, GRAPH_FOLD_SEED)).encode())
+        if family == "tfidf_cosine":
+            md5.update(("svd %d" % TFIDF_SVD_COMPONENTS).encode())
+        return md5.hexdigest()
+
     def get_features(self, ids):
         # ids = [source_id, target_id]
-
-        # features from self.data_tkzd_title
-        obs_tkzd_title_source = self.node_dict[ids[0]]["tkzd_title"]
-        obs_tkzd_title_target = self.node_dict[ids[1]]["tkzd_title"]
-
-        jaccard_tkzd_title = dist_utils._jaccard_coef(obs_tkzd_title_source, obs_tkzd_title_target)
-        dice_tkzd_title = dist_utils._dice_dist(obs_tkzd_title_source, obs_tkzd_title_target)
+        # n-gram sets come from the per-node cache built in `prepare_data`, in the order of NGRAM_FIELDS
+        features = []
+        for field, orders in NGRAM_FIELDS:
+            jaccards = []
+            dices = []
+            for n in orders:
+                grams_source = self.get_ngrams(ids[0], field, n)
+                grams_target = self.get_ngrams(ids[1], field, n)
+                jaccards.append(dist_utils._jaccard_coef(grams_source, grams_target))
+                dices.append(dist_utils._dice_dist(grams_source, grams_target))
+            features.extend(jaccards + dices)
 
         # TODO: # features from self.tkzd_title_rm_stpwds_stem
-
-        # features from self.data_tkzd_abstract
-        obs_tkzd_abstract_source = self.node_dict[ids[0]]["tkzd_abstract"]
-        obs_tkzd_abstract_target = self.node_dict[ids[1]]["tkzd_abstract"]
-        bigrams_tkzd_abstract_source = list(nltk.bigrams(obs_tkzd_abstract_source))
-        bigrams_tkzd_abstract_target = list(nltk.bigrams(obs_tkzd_abstract_target))
-        trigrams_tkzd_abstract_source = list(nltk.trigrams(obs_tkzd_abstract_source))
-        trigrams_tkzd_abstract_target = list(nltk.trigrams(obs_tkzd_abstract_target))
-
-        jaccard_tkzd_abstract = dist_utils._jaccard_coef(obs_tkzd_abstract_source, obs_tkzd_abstract_target)
-        jaccard_bigr_tkzd_abstract = dist_utils._jaccard_coef(bigrams_tkzd_abstract_source,
-                                                              bigrams_tkzd_abstract_target)
-        jaccard_trigr_tkzd_abstract = dist_utils._jaccard_coef(trigrams_tkzd_abstract_source,
-                                                               trigrams_tkzd_abstract_target)
-
-        dice_tkzd_abstract = dist_utils._dice_dist(obs_tkzd_abstract_source, obs_tkzd_abstract_target)
-        dice_bigr_tkzd_abstract = dist_utils._dice_dist(bigrams_tkzd_abstract_source, bigrams_tkzd_abstract_target)
-        dice_trigr_tkzd_abstract = dist_utils._dice_dist(trigrams_tkzd_abstract_source,
-                                                         trigrams_tkzd_abstract_target)
-
-        # features from self.data_tkzd_abstract_rm_stpwds
-        obs_tkzd_abstract_rm_stpwds_source = self.node_dict[ids[0]]["tkzd_abstract_rm_stpwds"]
-        obs_tkzd_abstract_rm_stpwds_target = self.node_dict[ids[1]]["tkzd_abstract_rm_stpwds"]
-        bigrams_tkzd_abstract_rm_stpwds_source = list(nltk.bigrams(obs_tkzd_abstract_rm_stpwds_source))
-        bigrams_tkzd_abstract_rm_stpwds_target = list(nltk.bigrams(obs_tkzd_abstract_rm_stpwds_target))
-        trigrams_tkzd_abstract_rm_stpwds_source = list(nltk.trigrams(obs_tkzd_abstract_rm_stpwds_source))
-        trigrams_tkzd_abstract_rm_stpwds_target = list(nltk.trigrams(obs_tkzd_abstract_rm_stpwds_target))
-
-        jaccard_tkzd_abstract_rm_stpwds = dist_utils._jaccard_coef(obs_tkzd_abstract_rm_stpwds_source,
-                                                                   obs_tkzd_abstract_rm_stpwds_target)
-        jaccard_bigr_tkzd_abstract_rm_stpwds = dist_utils._jaccard_coef(bigrams_tkzd_abstract_rm_stpwds_source,
-                                                                        bigrams_tkzd_abstract_rm_stpwds_target)
-        jaccard_trigr_tkzd_abstract_rm_stpwds = dist_utils._jaccard_coef(trigrams_tkzd_abstract_rm_stpwds_source,
-                                                                         trigrams_tkzd_abstract_rm_stpwds_target)
-
-        dice_tkzd_abstract_rm_stpwds = dist_utils._dice_dist(obs_tkzd_abstract_rm_stpwds_source,
-                                                             obs_tkzd_abstract_rm_stpwds_target)
-        dice_bigr_tkzd_abstract_rm_stpwds = dist_utils._dice_dist(bigrams_tkzd_abstract_rm_stpwds_source,
-                                                                  bigrams_tkzd_abstract_rm_stpwds_target)
-        dice_trigr_tkzd_abstract_rm_stpwds = dist_utils._dice_dist(trigrams_tkzd_abstract_rm_stpwds_source,
-                                                                   trigrams_tkzd_abstract_rm_stpwds_target)
-
         # TODO: # features from self.data_tkzd_abstract_rm_stpwds_stem
 
-        result = pd.Series([jaccard_tkzd_title,
-                            dice_tkzd_title,
-                            jaccard_tkzd_abstract,
-                            jaccard_bigr_tkzd_abstract,
-                            jaccard_trigr_tkzd_abstract,
-                            dice_tkzd_abstract,
-                            dice_bigr_tkzd_abstract,
-                            dice_trigr_tkzd_abstract,
-                            jaccard_tkzd_abstract_rm_stpwds,
-                            jaccard_bigr_tkzd_abstract_rm_stpwds,
-                            jaccard_trigr_tkzd_abstract_rm_stpwds,
-                            dice_tkzd_abstract_rm_stpwds,
-                            dice_bigr_tkzd_abstract_rm_stpwds,
-                            dice_trigr_tkzd_abstract_rm_stpwds,
-                            ])
+        result = pd.Series(features)
 
         return result
 
-    def get_graph_simi(self, ids, mode):
-        # ids is from data.data_train[["id_source", "id_target"]].apply(..., axis=1)
-        graphid_from, graphid_to = self.lookup_graph_id(ids)
-
+    def get_features_batch(self, batch_data):
+        # batch version of `get_features`, returns the same 14 columns for every row of batch_data
+        if self.ngram_matrices is None:
+            self.init_ngram_matrices()
+        rows_source = self.node_store.rows(batch_data["id_source"].values)
+        rows_target = self.node_store.rows(batch_data["id_target"].values)
+
+        features = []
+        for field, orders in NGRAM_FIELDS:
+            jaccards = []
+            dices = []
+            for n in orders:
+                jaccard, dice = ngram_utils._batch_jaccard_dice(self.ngram_matrices[(field, n)], rows_source,
+                                                                rows_target)
+                jaccards.append(jaccard)
+                dices.append(dice)
+            features.extend(jaccards + dices)
+        return pd.DataFrame(np.column_stack(features), index=batch_data.index)
+
+    def get_graph_simi(self, batch_data, mode):
+        # mean and sum of neighbourhood jaccard similarities for every row of batch_data, without the pair's own edge
+        # "from": over papers k citing graphid_to, jaccard of the citations of graphid_from and of k
+        # "to": over papers k cited by graphid_from, jaccard of the papers citing graphid_to and citing k
+        graphid_from, graphid_to = self.lookup_graph_ids(batch_data)
         if mode == "from":
-            graphid_in = self.graph_paper.neighbors(graphid_to, mode="IN")
-            try:
-                graphid_in.remove(graphid_from)
-            except:
-                pass
-            graphid_in = pd.Series(graphid_in)
-
-            simi_jaccard_in = graphid_in.apply(self.simi_jaccard, args=(graphid_from, graphid_to, "OUT",))
-            return [np.mean(simi_jaccard_in), np.sum(simi_jaccard_in)]
+            means, sums = graph_utils._neighbour_jaccard(self.out_paper, graphid_to, graphid_from,
+                                                         hub_degree=HUB_DEGREE, adjacency_t=self.in_paper)
         elif mode == "to":
-            graphid_out = self.graph_paper.neighbors(graphid_from, mode="OUT")
-            try:
-                graphid_out.remove(graphid_to)
-            except:
-                pass
-            graphid_out = pd.Series(graphid_out)
-
-            simi_jaccard_out = graphid_out.apply(self.simi_jaccard, args=(graphid_to, graphid_from, "IN"))
-            return [np.mean(simi_jaccard_out), np.sum(simi_jaccard_out)]
-
-    def get_node_dict(self):
-        # save node data to dictionary, index is "id"
-        self.node_dict = self.data_node_info.set_index('id').T.to_dict('series')
-
-    def get_pagerank(self, ids, direct):
-        # self.pagerank = self.graph.pagerank() before doing this
-        graphid_from, graphid_to = self.lookup_graph_id(ids)
-        if direct == "from":
-            return self.pagerank_paper[graphid_from]
-        if direct == "to":
-            return self.pagerank_paper[graphid_to]
+            means, sums = graph_utils._neighbour_jaccard(self.in_paper, graphid_from, graphid_to,
+                                                         hub_degree=HUB_DEGREE, adjacency_t=self.out_paper)
+        return pd.DataFrame(np.column_stack([means, sums]), index=batch_data.index)
+
+    def get_igraph(self, graph):
+        # igraph view of the full "paper" or "author" graph, vertex ids are node store rows and author ids;
+        # rebuilt from the sparse graphs on first use after a snapshot load
+        if graph == "paper":
+            if self.graph_paper.vcount() == 0:
+                self.graph_paper.add_vertices(self.node_store.ids.tolist())
+                self.graph_paper.add_edges(graph_utils._edge_list(self.base_adjacency_paper))
+            return self.graph_paper
+        elif graph == "author":
+            if self.graph_author.vcount() == 0:
+                self.graph_author.add_vertices(self.get_authors_list())
+                self.graph_author.add_edges(graph_utils._edge_list(self.base_citation_author))
+            return self.graph_author
+        raise KeyError("unknown graph %s, expected paper or author" % graph)
+
+    def get_link_scores(self, batch_data):
+        # link scores of every row of batch_data on the undirected paper graph, vertex ids are node store rows
+        rows_source = self.node_store.rows(batch_data["id_source"].values)
+        rows_target = self.node_store.rows(batch_data["id_target"].values)
+        return graph_utils._link_scores(self.neighbours_paper, self.degree_paper, rows_source, rows_target)
+
+    def get_minhash(self, field, n=1, num_perm=None):
+        # MinHash signatures of the n-gram sets of a token field, computed once per (field, n, num_perm)
+        num_perm = MINHASH_PERM if num_perm is None else num_perm
+        key = (field, n, num_perm)
+        if key not in self.minhash:
+            self.minhash[key] = sketch_utils._minhash(self.get_text_index(field, n).forward, num_perm=num_perm)
+        return self.minhash[key]
+
+    def get_minhash_jaccard(self, batch_data, field, n=1, num_perm=None):
+        # estimated n-gram jaccard of every (id_source, id_target) row of batch_data
+        signatures = self.get_minhash(field, n, num_perm)
+        rows_source = self.node_store.rows(batch_data["id_source"].values)
+        rows_target = self.node_store.rows(batch_data["id_target"].values)
+        return pd.Series(sketch_utils._minhash_jaccard(signatures, rows_source, rows_target), index=batch_data.index)
+
+    def get_minhash_report(self, field="tkzd_abstract", n=3, num_perms=(16, 32, 64, 128, 256), batch_data=None):
+        # error and time of the MinHash estimate against the exact n-gram jaccard on the pairs of batch_data
+        # (default: the training pairs), one row per signature length, to choose MINHASH_PERM
+        batch_data = self.data_train if batch_data is None else batch_data
+        rows_source = self.node_store.rows(batch_data["id_source"].values)
+        rows_target = self.node_store.rows(batch_data["id_target"].values)
+        matrix = self.get_text_index(field, n).forward
+        t0 = time.time()
+        inter = ngram_utils._batch_intersection(matrix, rows_source, rows_target)
+        sizes = ngram_utils._row_sizes(matrix)
+        exact = ngram_utils._batch_jaccard_coef(inter, sizes[rows_source], sizes[rows_target])
+        exact_time = time.time() - t0
+        report = []
+        for num_perm in num_perms:
+            t0 = time.time()
+            signatures = sketch_utils._minhash(matrix, num_perm=num_perm)
+            sketch_time = time.time() - t0
+            t0 = time.time()
+            estimate = sketch_utils._minhash_jaccard(signatures, rows_source, rows_target)
+            report.append({"num_perm": num_perm, "mean_abs_error": np.mean(np.abs(estimate - exact)),
+                           "max_abs_error": np.max(np.abs(estimate - exact)) if len(exact) else 0.0,
+                           "sketch_sec": sketch_time, "estimate_sec": time.time() - t0, "exact_sec": exact_time})
+        return pd.DataFrame(report)
+
+    def get_ngrams(self, node_id, field, n):
+        # cached n-gram set of one node: sorted unique gram ids, a view on self.ngram_matrices
+        if self.ngram_matrices is None:
+            self.init_ngram_matrices()
+        matrix = self.ngram_matrices[(field, n)]
+        row = self.node_store.row[node_id]
+        return matrix.indices[matrix.indptr[row]: matrix.indptr[row + 1]]
+
+    def get_node_store(self):
+        # columnar node data, rows are indexed by self.node_store.row[id]
+        self.node_store = NodeStore(self.data_node_info["id"].values, self.data_node_info["year"].values)
+
+    def get_pairs(self, data_set):
+        # what a row is cached by in the feature store: source, target and label (-1 for test)
+        if data_set == "train":
+            return self.data_train[["id_source", "id_target", "predict"]].values
+        elif data_set == "test":
+            pairs = self.data_test[["id_source", "id_target"]].values
+            return np.column_stack([pairs, np.full(pairs.shape[0], -1)])
+
+    def get_pair_features(self, pairs, n_jobs=N_JOBS, columns=None):
+        # every feature family of a frame of (id_source, id_target) pairs, all columns of FEATURE_FAMILIES as
+        # float32 like the feature store holds them for the training pairs. Given columns (positions in all
+        # columns), only the families holding one of them are computed, the columns of the others are nan
+        self.data_stream = pairs
+        features = []
+        start = 0
+        for family, names in FEATURE_FAMILIES:
+            stop = start + len(names)
+            if columns is None or any(start <= column < stop for column in columns):
+                features.append(self.get_family("stream", family, n_jobs=n_jobs))
+            else:
+                features.append(pd.DataFrame(np.nan, index=pairs.index, columns=names))
+            start = stop
+        self.data_stream = None
+        features = pd.concat(features, axis=1)
+        features.columns = [name for _, names in FEATURE_FAMILIES for name in names]
+        return features.astype(np.float32)
+
+    def get_scores(self, pairs, model, columns, scaler, proba=False, threshold=None):
+        # model output for a frame of (id_source, id_target) pairs: every feature family, the training column
+        # selection and scaling, then model.predict (the positive class probability if proba, or whether it
+        # reaches threshold if given)
+        if pairs.shape[0] == 0:
+            # sklearn scalers and models refuse zero rows
+            return np.zeros(0) if proba else np.zeros(0, dtype=int)
+        features = scaler.transform(self.get_pair_features(pairs, columns=columns).iloc[:, columns].fillna(0))
+        if proba:
+            return model_utils._predict_score(model, features)
+        if threshold is not None:
+            return (model_utils._predict_score(model, features) >= threshold).astype(int)
+        return model.predict(features)
+
+    def get_similar_pairs(self, field, n=1, bands=32, num_perm=None, max_bucket_size=LSH_MAX_BUCKET_SIZE):
+        # (id_a, id_b) pairs of papers whose n-gram sets of field are likely similar, from an LSH banding
+        # index over the MinHash signatures; see `sketch_utils.LSHIndex.threshold` for the similarity targeted
+        index = sketch_utils.LSHIndex(self.get_minhash(field, n, num_perm), bands)
+        pairs = index.candidate_pairs(max_bucket_size=max_bucket_size)
+        return pd.DataFrame({"id_a": self.node_store.ids[pairs[:, 0]], "id_b": self.node_store.ids[pairs[:, 1]]})
+
+    def get_snapshot_meta(self, part):
+        # what a snapshot part is valid for: the snapshot version and the content of its inputs
+        meta = {"version": SNAPSHOT_VERSION, "node_info": feature_utils._file_md5(DIR_NODEINFO)}
+        if part == "graph":
+            edges = self.data_train_positive[["id_source", "id_target"]].values.astype(np.int64)
+            edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+            meta["train_positive"] = hashlib.md5(np.ascontiguousarray(edges).tobytes()).hexdigest()
+        return meta
 
     def get_valid_ids(self, data):
         assert type(dir) == list
@@ -405,42 +657,105 @@ class Data():
             valid_ids.add(element[1])
         return valid_ids
 
+    def get_text_index(self, field, n=1, min_idf=None):
+        # inverted index of the n-grams of a token field of the node store, built once per (field, n, min_idf)
+        key = (field, n, min_idf)
+        if key not in self.text_indexes:
+            if self.ngram_matrices is not None and (field, n) in self.ngram_matrices:
+                index = index_utils.InvertedIndex(self.ngram_matrices[(field, n)], min_idf=min_idf)
+            elif n == 1:
+                values, offsets = self.node_store.tokens[field]
+                index = index_utils.InvertedIndex.from_ids(values, offsets, len(self.node_store.words),
+                                                           min_idf=min_idf)
+            else:
+                matrix, _ = ngram_utils._encode_ngrams(self.node_store.get_token_lists(field), n)
+                index = index_utils.InvertedIndex(matrix, min_idf=min_idf)
+            self.text_indexes[key] = index
+        return self.text_indexes[key]
+
+    def get_text_overlap(self, paper_id, field="tkzd_abstract_rm_stpwds", n=1, min_shared=1, min_idf=None):
+        # papers sharing at least min_shared n-grams of field with paper_id and how many, most shared first
+        index = self.get_text_index(field, n, min_idf=min_idf)
+        rows, counts = index.query(self.node_store.rows([paper_id])[0], min_shared=min_shared)
+        return pd.DataFrame({"id": self.node_store.ids[rows], "shared": counts})
+
     def get_year(self, ids, return_type="graph_id"):
         # need self.id_graphid
         # input: int: id1 and id2
 
-        year_id1 = self.node_dict[ids[0]]["year"]
-        year_id2 = self.node_dict[ids[1]]["year"]
+        year_id1 = self.node_store.years[self.node_store.row[ids[0]]]
+        year_id2 = self.node_store.years[self.node_store.row[ids[1]]]
         if return_type == "graph_id":
             if year_id1 >= year_id2:  # TODO: how to deal with papers in same year, I ignore it now
                 return year_id1 - year_id2
             else:
                 return year_id1 - year_id1
 
+    def init_candidate_sources(self):
+        # (left, right) sparse factors of every candidate source of `get_candidates`, the scores of query
+        # rows are left[queries].dot(right)
+        authors = self.node_store.authors
+        by_author = index_utils.InvertedIndex.from_ids(authors.values, authors.offsets, len(authors))
+        by_ngram = self.get_text_index(*CANDIDATE_NGRAM, min_idf=CANDIDATE_MIN_IDF)
+        self.candidate_sources = [(by_author.forward, by_author.postings),
+                                  (self.neighbours_paper, self.neighbours_paper),
+                                  (by_ngram.forward, by_ngram.postings)]
+
     def init_graph_author(self):
+        # run after `init_graph_paper`; vertex ids are the author ids of the node store
         authors_list = self.get_authors_list()
         self.graph_author.add_vertices(authors_list)
-        # add author vertice
-        for i in range(self.graph_author.vcount()):
-            self.id_graphid_author[self.graph_author.vs["name"][i]] = i
-        # add citation edges
-        author_citation_edges = self.data_train_positive[["id_source", "id_target"]].apply(self.author_citation_edge,
-                                                                                           axis=1)
-        list_citation_edges = author_citation_edges.tolist()
-        list_citation_edges = [x for x in list_citation_edges if str(x) != "nan"]
-        list_citation_edges = [y for x in list_citation_edges for y in x]
-
-        self.graph_author.add_edges(list_citation_edges)
+        self.id_graphid_author = dict(self.node_store.authors.author_id)
+        # add citation edges: every author of the citing paper cites every author of the cited paper
+        _, from_authors, to_authors = self.get_author_pairs(self.data_train_positive)
+        list_citation_edges = np.column_stack([from_authors, to_authors])
+        self.graph_author.add_edges(list_citation_edges.tolist())
+        # author x author citation counts, citation_author[a, b] = how many times did a cite b
+        self.base_citation_author = graph_utils._adjacency(list_citation_edges, len(authors_list))
+        self.citation_author = self.base_citation_author
+        self.base_centrality_author = self.centrality_author = centrality_utils.Centrality(self.base_citation_author)
 
     def init_graph_paper(self):
-        # run after `prepare_data`, need self.node_dict
-        self.graph_paper.add_vertices(list(self.node_dict.keys()))
-
-        for i in range(self.node_dict.__len__()):
-            self.id_graphid_paper[self.graph_paper.vs["name"][i]] = i
-        edges = self.data_train_positive[["id_source", "id_target"]].apply(self.get_direct, axis=1)
+        # run after `prepare_data`, need self.node_store
+        # vertex ids are the rows of the node store
+        self.graph_paper.add_vertices(self.node_store.ids.tolist())
+        self.id_graphid_paper = dict(self.node_store.row)
+        # edges point from the newer to the older paper, see `get_direct`
+        graphid_from, graphid_to = self.lookup_graph_ids(self.data_train_positive)
+        edges = np.column_stack([graphid_from, graphid_to])
         self.graph_paper.add_edges(edges.tolist())
 
+        self.base_adjacency_paper = graph_utils._adjacency(edges, len(self.node_store))
+        self.adjacency_paper = self.base_adjacency_paper
+        self.base_centrality_paper = self.centrality_paper = centrality_utils.Centrality(self.base_adjacency_paper)
+        self.init_paper_views()
+
+    def init_paper_views(self):
+        # sparse views of self.adjacency_paper used by the batch link scores and network features
+        self.neighbours_paper, self.degree_paper = graph_utils._undirected(self.adjacency_paper)
+        self.out_paper = graph_utils._binary(self.adjacency_paper)
+        self.in_paper = self.out_paper.T.tocsr()
+        self.candidate_sources = None
+
+    def init_ngram_matrices(self):
+        # encode the n-gram sets of every node once as binary CSR rows, the per-node n-gram cache
+        self.ngram_matrices = {}
+        for field, orders in NGRAM_FIELDS:
+            token_lists = self.node_store.get_token_lists(field)
+            for n in orders:
+                self.ngram_matrices[(field, n)], _ = ngram_utils._encode_ngrams(token_lists, n)
+
+    def init_tfidf_vectors(self):
+        # L2-normalized tf-idf rows of every field of TFIDF_FIELDS, fitted once on all papers; truncated-SVD
+        # vectors instead if TFIDF_SVD_COMPONENTS > 0
+        self.tfidf_vectors = {}
+        for field in TFIDF_FIELDS:
+            values, offsets = self.node_store.tokens[field]
+            vectors = tfidf_utils._tfidf(values, offsets, len(self.node_store.words))
+            if TFIDF_SVD_COMPONENTS > 0:
+                vectors = tfidf_utils._svd(vectors, TFIDF_SVD_COMPONENTS)
+            self.tfidf_vectors[field] = vectors
+
     def load_data(self):
         # (0) paper unique ID (integer)
         # (1) publication year (integer)
@@ -453,122 +768,183 @@ class Data():
         self.data_node_info = pd.read_csv(DIR_NODEINFO, names=["id", "year", "title", "author", "journal", "abstract"],
                                           header=None)
 
-    def lookup_author_pagerank_from(self, edge):
-        return self.pagerank_author[edge[0]]
-
-    def lookup_author_pagerank_to(self, edge):
-        return self.pagerank_author[edge[1]]
+    def load_snapshot(self, path, part):
+        # load part ("node": node store and n-gram cache, "graph": paper and author graphs) from the snapshot
+        # in path, memory-mapped; returns False when there is none or its inputs changed
+        part_path = os.path.join(path, part)
+        if not snapshot_utils._is_valid(part_path, self.get_snapshot_meta(part)):
+            return False
+        if part == "node":
+            self.node_store = NodeStore.load(part_path)
+            self.ngram_matrices = {}
+            for field, orders in NGRAM_FIELDS:
+                for n in orders:
+                    self.ngram_matrices[(field, n)] = snapshot_utils._load_csr(part_path, "ngram_%s_%d" % (field, n))
+        elif part == "graph":
+            self.base_adjacency_paper = snapshot_utils._load_csr(part_path, "adjacency_paper")
+            self.base_citation_author = snapshot_utils._load_csr(part_path, "citation_author")
+            self.base_centrality_paper = centrality_utils.Centrality(self.base_adjacency_paper)
+            self.base_centrality_author = centrality_utils.Centrality(self.base_citation_author)
+            self.mask_graphs()
+            # the igraph views of the same graphs are only built on first use, see `get_igraph`
+            self.graph_paper = igraph.Graph(directed=True)
+            self.id_graphid_paper = dict(self.node_store.row)
+            self.graph_author = igraph.Graph(directed=True)
+            self.id_graphid_author = dict(self.node_store.authors.author_id)
+        print("%s snapshot loaded" % part)
+        return True
 
     def lookup_graph_id(self, ids):
         # ids is from data.data_train[["id_source", "id_target"]].apply(..., axis=1)
         graphids = self.get_direct(ids)
         return graphids[0], graphids[1]
 
-    def meanAciteB(self, input_list, mode="out"):
-        # input_list: e.g. [(123,456), (234,252)]
-        if mode == "out":
-            if type(input_list) == list:
-                acitebs = list(map(self.AciteB, input_list))
-                return [np.mean(acitebs), np.max(acitebs), np.sum(acitebs)]
-            else:
-                return [0, 0, 0]
-        elif mode == "all":
-            if type(input_list) == list:
-                acitebs = list(map(self.AciteB_all, input_list))
-                return [np.mean(acitebs), np.max(acitebs), np.sum(acitebs)]
-            else:
-                return [0, 0, 0]
-
-    def meanBciteA(self, input_list):
-        # input_list: e.g. [(123,456), (234,252)]
-        if type(input_list) == list:
-            bciteas = list(map(self.BciteA, input_list))
-            return [np.mean(bciteas), np.max(bciteas), np.sum(bciteas)]
-        else:
-            return [0, 0, 0]
+    def lookup_graph_ids(self, batch_data):
+        # vectorized `lookup_graph_id` for every row of batch_data
+        rows_source = self.node_store.rows(batch_data["id_source"].values)
+        rows_target = self.node_store.rows(batch_data["id_target"].values)
+        source_first = self.node_store.years[rows_source] >= self.node_store.years[rows_target]
+        return np.where(source_first, rows_source, rows_target), np.where(source_first, rows_target, rows_source)
+
+    def mask_graphs(self, excluded=None):
+        # graphs without the positive pairs of `excluded` (rows like self.data_train), made by subtracting
+        # their edges from the full graphs; None restores the full graphs
+        self.adjacency_paper = self.base_adjacency_paper
+        self.citation_author = self.base_citation_author
+        self.centrality_paper = self.base_centrality_paper
+        self.centrality_author = self.base_centrality_author
+        if excluded is not None:
+            excluded = excluded[excluded["predict"] == 1]
+            graphid_from, graphid_to = self.lookup_graph_ids(excluded)
+            self.adjacency_paper = graph_utils._remove_edges(self.base_adjacency_paper,
+                                                            np.column_stack([graphid_from, graphid_to]))
+            _, from_authors, to_authors = self.get_author_pairs(excluded)
+            self.citation_author = graph_utils._remove_edges(self.base_citation_author,
+                                                             np.column_stack([from_authors, to_authors]))
+            self.centrality_paper = centrality_utils.Centrality(self.adjacency_paper)
+            self.centrality_author = centrality_utils.Centrality(self.citation_author)
+        self.init_paper_views()
+
+    def prepare(self, snapshot_dir=SNAPSHOT_DIR):
+        # node store, n-gram cache and graphs, from the snapshot in snapshot_dir while its inputs are unchanged
+        if snapshot_dir is None or not self.load_snapshot(snapshot_dir, "node"):
+            self.get_node_store()
+            self.prepare_data()
+            if snapshot_dir is not None:
+                self.save_snapshot(snapshot_dir, "node")
+        if snapshot_dir is None or not self.load_snapshot(snapshot_dir, "graph"):
+            self.init_graph_paper()
+            self.init_graph_author()
+            if snapshot_dir is not None:
+                self.save_snapshot(snapshot_dir, "graph")
 
     def prepare_data(self, delete=True):
-        # title
-        # convert to lowercase and tokenize
-        tkzd_title = self.data_node_info["title"].apply(lambda x: x.lower().split(" "))
-        self.data_node_info["tkzd_title"] = tkzd_title
-        # remove stopwords
-        tkzd_title_rm_stpwds = self.data_node_info["tkzd_title"].apply(
-            lambda x: [token for token in x if token not in STPWDS])
-        self.data_node_info["tkzd_title_rm_stpwds"] = tkzd_title_rm_stpwds
-        # convert to root or original word
-        tkzd_title_rm_stpwds_stem = self.data_node_info["tkzd_title_rm_stpwds"].apply(
-            lambda x: [self.stemmer.stem(token) for token in x])
-        self.data_node_info["tkzd_title_rm_stpwds_stem"] = tkzd_title_rm_stpwds_stem
-
-        # authors
-        re_author = self.data_node_info["author"].apply(
-            lambda x: re.sub(r'\(.*?\)|\s|\\\"\"\{|\\\"\"\{\\|\\\\\'|\\\'|\\\"\"|\\\"|\\|\}|\'', "",
-                             x) if x is not np.nan else np.nan)  # delete contents in brackets and useless space
-        re_author = re_author.apply(lambda x: re.sub(r'\(.*', "", x) if x is not np.nan else np.nan)
-        re_author = re_author.apply(lambda x: re.sub(r'\&', ",", x) if x is not np.nan else np.nan)
-        tkzd_author = re_author.apply(lambda x: x.lower().split(",") if x is not np.nan else np.nan)
-        self.data_node_info["tkzd_author"] = tkzd_author
+        # tokenized columns go to the node store as token ids, the time of every stage is kept in
+        # self.prepare_timings
+        self.prepare_timings = OrderedDict()
+        if self.node_store is None:
+            self.get_node_store()
+        store = self.node_store
+
+        for column in ["title", "abstract"]:
+            # convert to lowercase and tokenize
+            t0 = time.time()
+            values, offsets = text_utils._tokenize(self.data_node_info[column].values, store.encode_words)
+            store.set_tokens("tkzd_%s" % column, values, offsets)
+            self.prepare_timings["tokenize %s" % column] = time.time() - t0
+
+            # remove stopwords
+            t0 = time.time()
+            is_stpwd = np.array([word in STPWDS for word in store.words], dtype=bool)
+            values, offsets = text_utils._filter_tokens(values, offsets, ~is_stpwd)
+            store.set_tokens("tkzd_%s_rm_stpwds" % column, values, offsets)
+            self.prepare_timings["remove stopwords %s" % column] = time.time() - t0
+
+            # convert to root or original word, every distinct word is stemmed once
+            t0 = time.time()
+            words = list(store.words)
+            stems = np.asarray(store.encode_words([self.stem(word) for word in words]), dtype=np.int32)
+            values, offsets = text_utils._map_tokens(values, offsets, stems)
+            store.set_tokens("tkzd_%s_rm_stpwds_stem" % column, values, offsets)
+            self.prepare_timings["stem %s" % column] = time.time() - t0
+
+        # authors: cleaned in one pass and interned to author ids
+        t0 = time.time()
+        store.authors.add(self.data_node_info["author"].values)
+        self.prepare_timings["authors"] = time.time() - t0
         # TODO: handle (School) (number)
 
         # journal name
         # TODO: self.data_node_info["journal"]
 
-        # abstract
-        # convert to lowercase and tokenize
-        tkzd_abstract = self.data_node_info["abstract"].apply(lambda x: x.lower().split(" "))
-        self.data_node_info["tkzd_abstract"] = tkzd_abstract
-
-        # remove stopwords
-        tkzd_abstract_rm_stpwds = self.data_node_info["tkzd_abstract"].apply(
-            lambda x: [token for token in x if token not in STPWDS])
-        self.data_node_info["tkzd_abstract_rm_stpwds"] = tkzd_abstract_rm_stpwds
-
-        # convert to root or original word
-        tkzd_abstract_rm_stpwds_stem = self.data_node_info["tkzd_abstract_rm_stpwds"].apply(
-            lambda x: [self.stemmer.stem(token) for token in x])
-        self.data_node_info["tkzd_abstract_rm_stpwds_stem"] = tkzd_abstract_rm_stpwds_stem
-
-        # save node data to dictionary, index is "id"
-        self.node_dict = self.data_node_info.set_index('id').T.to_dict('series')
+        # per-node n-gram cache, shared by `get_features` and `get_features_batch`
+        t0 = time.time()
+        self.init_ngram_matrices()
+        self.prepare_timings["n-gram cache"] = time.time() - t0
         if delete:
             del (self.data_node_info)
 
+        for stage, seconds in self.prepare_timings.items():
+            print("    %s: %.2f sec" % (stage, seconds))
         print("data prepared")
 
+    def recommend(self, query_ids, model, columns, scaler, k=None, query_chunk_size=10000):
+        # the k candidates (see `get_candidates`) of every query paper with the highest model probability of
+        # being cited by it, as (id_source, id_target, score) rows, best first per query
+        k = TOP_K if k is None else k
+        if self.base_adjacency_paper is None:
+            self.prepare(SNAPSHOT_DIR)
+        recommendations = []
+        for start in range(0, len(query_ids), query_chunk_size):
+            pairs = self.get_candidates(query_ids[start: start + query_chunk_size])
+            pairs["score"] = self.get_scores(pairs, model, columns, scaler, proba=True)
+            pairs = pairs.sort_values(["id_source", "score"], ascending=[True, False], kind="mergesort")
+            recommendations.append(pairs.groupby("id_source", sort=False).head(k))
+        return pd.concat(recommendations, axis=0, ignore_index=True)
+
     def sample(self, prop, load=False):
         # to test code we select sample
         if load:
-            features_node = pd.read_csv("features_node", header=0, index_col=0)
-            features_index = features_node.index
-            self.data_train = self.data_train.ix[features_index]
-            self.data_train_positive = self.data_train[self.data_train["predict"] == 1]
+            features_index = FeatureStore(FEATURE_DIR, FEATURE_FAMILIES).load_index("train")
+            self.data_train = self.data_train.loc[features_index]
         else:
             to_keep = random.sample(range(self.data_train.shape[0]), k=int(round(self.data_train.shape[0] * prop)))
-            self.data_train = self.data_train.iloc[to_keep]
-            self.data_train_positive = self.data_train[self.data_train["predict"] == 1]
-
-    def simi_jaccard(self, graphid_in, graphid_from, graphid_to, mode):
-
-        graphid_from_neighbors = self.graph_paper.neighbors(graphid_from, mode=mode)
-        graphid_in_neighbors = self.graph_paper.neighbors(graphid_in, mode=mode)
-        try:
-            graphid_from_neighbors.remove(graphid_to)
-        except:
-            pass
-        graphid_in_neighbors.remove(graphid_to)
-        simi_jaccard = dist_utils._jaccard_coef(graphid_from_neighbors, graphid_in_neighbors)
-        return simi_jaccard
-
-    def similarity(self, ids, graph, method="adamic_adar", direct=False):
-        if direct:
-            pass
-        else:
-            i = self.id_graphid_paper[ids[0]]
-            j = self.id_graphid_paper[ids[1]]
-        if method == "adamic_adar":
-            return sum([1.0 / math.log(graph.degree(v)) for v in
-                        set(graph.neighbors(i)).intersection(set(graph.neighbors(j)))])
+            self.data_train = self.data_train.iloc[sorted(to_keep)]
+        # rows in pair order whatever order they were drawn in: the feature store rows, the fold splits and the
+        # ensemble cache keys follow it, so the same pairs find the same cached features and predictions
+        self.data_train = self.data_train.sort_values(["id_source", "id_target"], kind="mergesort")
+        self.data_train_positive = self.data_train[self.data_train["predict"] == 1]
+
+    def score_stream(self, path, model, output, columns, scaler, chunk_size=None, threshold=None):
+        # predict the (source, target) pairs of the file in path chunk by chunk: every feature family, the
+        # training column selection and scaling, then model.predict, appended to the csv output. Memory is
+        # bounded by one chunk next to the node store and the graphs
+        chunk_size = STREAM_CHUNK_SIZE if chunk_size is None else chunk_size
+        if self.base_adjacency_paper is None:
+            self.prepare(SNAPSHOT_DIR)
+        n_scored = 0
+        with open(output, "w") as f:
+            for chunk in pd.read_csv(path, names=["id_source", "id_target"], header=None, sep=" ",
+                                     dtype=np.int64, chunksize=chunk_size):
+                t0 = time.time()
+                chunk = chunk.assign(prediction=self.get_scores(chunk, model, columns, scaler, threshold=threshold))
+                chunk.to_csv(f, index=False, header=n_scored == 0)
+                n_scored += chunk.shape[0]
+                print("scored %d pairs (%.2f sec for the last chunk)" % (n_scored, time.time() - t0))
+        return n_scored
+
+    def save_snapshot(self, path, part):
+        # write part ("node" or "graph", see `load_snapshot`) of the prepared state to path
+        part_path = os.path.join(path, part)
+        snapshot_utils._start(part_path)
+        if part == "node":
+            self.node_store.save(part_path)
+            for (field, n), matrix in self.ngram_matrices.items():
+                snapshot_utils._save_csr(part_path, "ngram_%s_%d" % (field, n), matrix)
+        elif part == "graph":
+            snapshot_utils._save_csr(part_path, "adjacency_paper", self.base_adjacency_paper)
+            snapshot_utils._save_csr(part_path, "citation_author", self.base_citation_author)
+        snapshot_utils._finish(part_path, self.get_snapshot_meta(part))
 
     def split_to_list(self, data, by=" "):
         assert type(data) == list
@@ -576,242 +952,234 @@ class Data():
 
 
 class Ensemble(object):
-    def __init__(self, n_folds, stacker, base_models):
+    # parameters that change how fast a model fits, not what it predicts; left out of its cache key
+    RUNTIME_PARAMS = ("n_jobs", "nthread", "verbose", "verbosity", "silent")
+
+    def __init__(self, n_folds, stacker, base_models, n_jobs=N_JOBS, path=ENSEMBLE_DIR, seed=7,
+                 early_stopping_rounds=None, valid_size=VALID_SIZE, max_boost_rounds=MAX_BOOST_ROUNDS,
+                 keep_models=False):
+        # n_jobs: cores for the first layer, (model, fold) jobs run concurrently as far as every model's own
+        # n_jobs leaves cores free; path: where X and T are memory-mapped from and where the out-of-fold and
+        # test predictions of every base model are cached; seed: of the fold split; early_stopping_rounds:
+        # boosting base models get up to max_boost_rounds rounds, instead of their own n_estimators, and stop when
+        # a valid_size part of their training folds stalls this many rounds;
+        # keep_models: the fitted fold models are pickled next to the cached predictions and kept in fold_models
         self.n_folds = n_folds
         self.stacker = stacker
         self.base_models = base_models
+        self.n_jobs = n_jobs
+        self.path = path
+        self.seed = seed
+        self.early_stopping_rounds = early_stopping_rounds
+        self.valid_size = valid_size
+        self.max_boost_rounds = max_boost_rounds
+        self.keep_models = keep_models
+        # fold_models[i][j]: base model i fitted on fold j, with keep_models
+        self.fold_models = None
+        # decision threshold on the stacker probability, tuned for f1 by `fit_predict`
+        self.threshold = 0.5
+        # set by `fit_predict`, shared read-only with the forked fold workers
+        self.X = None
+        self.y = None
+        self.T = None
+        self.folds = None
+        self.fingerprint = None
+        self.model_keys = None
+
+    def fit_fold(self, i, j):
+        # fit base model i on the training part of fold j; returns (i, j, out-of-fold predictions,
+        # test predictions, wall time, peak memory of the worker in MB)
+        t0 = time.time()
+        train_idx, test_idx = self.folds[j]
+        clf = clone(self.base_models[i])
+        if self.early_stopping_rounds and model_utils._supports_early_stopping(clf):
+            # stop on a held-out part of the training folds, the out-of-fold rows stay unseen
+            clf.set_params(n_estimators=self.max_boost_rounds)
+            shuffled = np.random.RandomState(self.seed + j).permutation(train_idx)
+            n_valid = max(int(len(train_idx) * self.valid_size), 1)
+            valid_idx, fit_idx = shuffled[:n_valid], np.sort(shuffled[n_valid:])
+            model_utils._fit_early_stopping(clf, self.X[fit_idx], self.y[fit_idx], self.X[valid_idx],
+                                            self.y[valid_idx], self.early_stopping_rounds)
+        else:
+            clf.fit(self.X[train_idx], self.y[train_idx])
+        if self.keep_models:
+            # written by the worker, the model is not sent back through the pool
+            with open(self.get_fold_model_file(i, j), "wb") as f:
+                pickle.dump(clf, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return (i, j, model_utils._predict_score(clf, self.X[test_idx]), model_utils._predict_score(clf, self.T),
+                time.time() - t0, parallel_utils._peak_memory())
 
     def fit_predict(self, X, y, T):
-        X = np.array(X)
-        y = np.array(y)
-        T = np.array(T)
+        self.X, self.T = self.share(X, T)
+        self.y = np.asarray(y)
+        self.folds = list(KFold(n_splits=self.n_folds, shuffle=True, random_state=self.seed).split(self.X))
+        self.fingerprint = self.get_fingerprint()
+        self.model_keys = [self.get_model_key(clf) for clf in self.base_models]
+        self.remove_stale()
 
-        folds = list(KFold(len(y), n_folds=self.n_folds, shuffle=True, random_state=7))
-
-        S_train = np.zeros((X.shape[0], len(self.base_models)))
-        S_test = np.zeros((T.shape[0], len(self.base_models)))
+        S_train = np.zeros((self.X.shape[0], len(self.base_models)))
+        S_test = np.zeros((self.T.shape[0], len(self.base_models)))
+        n_cores = parallel_utils._n_jobs(self.n_jobs)
 
         for i, clf in enumerate(self.base_models):
-            S_test_i = np.zeros((T.shape[0], len(folds)))
-
-            for j, (train_idx, test_idx) in enumerate(folds):
-                t0 = time.clock()
-                print("\nTraining model %i, fold %i" % ((i + 1), (j + 1)))
-                X_train = X[train_idx]
-                y_train = y[train_idx]
-                X_holdout = X[test_idx]
-                # y_holdout = y[test_idx]
-                clf.fit(X_train, y_train)
-                y_pred = clf.predict(X_holdout)[:]
-                S_train[test_idx, i] = y_pred
-                S_test_i[:, j] = clf.predict(T)[:]
-
-                print("    mean of fold prediction: ", np.mean(S_train[test_idx, i], axis=0))
-                print("    time for this fold: %.2f sec" % (time.clock() - t0))
+            # first layer predictions of an unchanged model on unchanged data come from the cache
+            cache_file = os.path.join(self.path, "model_%s.npz" % self.model_keys[i])
+            if os.path.exists(cache_file) and (not self.keep_models or all(
+                    os.path.exists(self.get_fold_model_file(i, j)) for j in range(len(self.folds)))):
+                cached = np.load(cache_file)
+                S_train[:, i] = cached["train"]
+                S_test[:, i] = cached["test"]
+                print("\nModel %i: out-of-fold and test predictions loaded from %s" % ((i + 1), cache_file))
+                continue
+
+            # a model using k cores itself runs n_cores // k folds at a time
+            n_threads = getattr(clf, "n_jobs", None)
+            n_threads = 1 if n_threads is None else parallel_utils._n_jobs(n_threads)
+            n_workers = max(min(n_cores // n_threads, len(self.folds)), 1)
+            print("\nTraining model %i, %i folds at a time" % ((i + 1), n_workers))
+            S_test_i = np.zeros((self.T.shape[0], len(self.folds)))
+
+            jobs = [(i, j) for j in range(len(self.folds))]
+            for _, j, y_pred, t_pred, seconds, peak_memory in parallel_utils._imap_shared(
+                    self, "fit_fold", jobs, n_jobs=n_workers, fresh=True):
+                S_train[self.folds[j][1], i] = y_pred
+                S_test_i[:, j] = t_pred
+                print("    fold %i: mean of fold prediction %.6f, %.2f sec, peak memory %.0f MB"
+                      % ((j + 1), np.mean(y_pred), seconds, peak_memory))
 
             print("mean of model prediction: ", np.mean(S_train[:, i], axis=0))
 
             S_test[:, i] = S_test_i.mean(1)
+            np.savez(cache_file, train=S_train[:, i], test=S_test[:, i])
 
         print("\nFirst layer finished\n")
+        if self.keep_models:
+            self.fold_models = []
+            for i in range(len(self.base_models)):
+                self.fold_models.append([])
+                for j in range(len(self.folds)):
+                    with open(self.get_fold_model_file(i, j), "rb") as f:
+                        self.fold_models[i].append(pickle.load(f))
+        # decision threshold maximizing f1 of the stacker's own out-of-fold probabilities
+        stacker_oof = cross_val_predict(clone(self.stacker), S_train, self.y, cv=self.folds, method="predict_proba")
+        self.threshold, f1 = model_utils._best_f1_threshold(self.y, stacker_oof[:, 1])
+        print("threshold: %.6f, out-of-fold F1 of the stacker: %.10f" % (self.threshold, f1))
         self.stacker.fit(S_train, y)
-        y_pred = self.stacker.predict(S_test)[:]
+        y_pred = (model_utils._predict_score(self.stacker, S_test) >= self.threshold).astype(int)
         return y_pred, S_train, S_test
 
+    def get_fingerprint(self):
+        # content of the feature matrices, the labels and the fold split the first layer is fitted on
+        md5 = hashlib.md5()
+        for matrix in (self.X, self.y, self.T):
+            md5.update(str(matrix.shape).encode())
+            md5.update(np.ascontiguousarray(matrix).tobytes())
+        md5.update(("folds %d %d" % (self.n_folds, self.seed)).encode())
+        return md5.hexdigest()
+
+    def get_fold_model_file(self, i, j):
+        return os.path.join(self.path, "model_%s_fold%d.pkl" % (self.model_keys[i], j))
+
+    def get_model_key(self, clf):
+        # cache key of a base model's predictions: its class and hyperparameters and the data fingerprint
+        params = sorted((name, repr(value)) for name, value in clf.get_params().items()
+                        if name not in self.RUNTIME_PARAMS)
+        md5 = hashlib.md5()
+        md5.update(("%s %s %s" % (type(clf).__name__, params, self.fingerprint)).encode())
+        # probabilities (`model_utils._predict_score`), early stopping settings
+        md5.update(("score 1 %s %s %s" % (self.early_stopping_rounds, self.valid_size, self.max_boost_rounds)).encode())
+        return md5.hexdigest()
+
+    def remove_stale(self):
+        # cached predictions and fold models under self.path of keys other than the current base models': those
+        # of changed models or data are never read again
+        for name in os.listdir(self.path):
+            match = re.match(r"model_([0-9a-f]{32})(\.npz|_fold\d+\.pkl)$", name)
+            if match and match.group(1) not in self.model_keys:
+                os.remove(os.path.join(self.path, name))
+
+    def share(self, X, T):
+        # X and T written once to self.path and memory-mapped read-only, the fold workers page them in
+        # instead of each holding a copy
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        shared = []
+        for name, matrix in [("X", X), ("T", T)]:
+            matrix_file = os.path.join(self.path, "%s.npy" % name)
+            np.save(matrix_file, np.asarray(matrix, dtype=np.float64))
+            shared.append(np.load(matrix_file, mmap_mode="r"))
+        return shared
+
 
 if __name__ == '__main__':
     data = Data(sample=True)
     data.load_data()
     data.sample(prop=1, load=LOAD_SAMPLE)
-
-    if RUN_FOR_FIRST_TIME:
-
-        data.get_node_dict()
-        data.prepare_data()
-        data.init_graph_paper()
-        data.init_graph_author()
-
-        features_network_to = pd.read_csv("features_network_to", header=0, index_col=0)
-        features_network_from = pd.read_csv("features_network_from", header=0, index_col=0)
-        test_features_network_to = pd.read_csv("test_features_network_to", header=0, index_col=0)
-        test_features_network_from = pd.read_csv("test_features_network_from", header=0, index_col=0)
-
-        t0 = time.clock()
-        features_node = data.get_batch(0, data.data_train.shape[0], "train", get_item="node")
-        features_network_from = data.get_batch(0, data.data_train.shape[0], "train", get_item="network_jaccard_from")
-        features_network_to = data.get_batch(0, data.data_train.shape[0], "train", get_item="network_jaccard_to")
-        features_network = pd.concat([features_network_from, features_network_to, np.max(
-            pd.concat([features_network_from.iloc[:, 0], features_network_to.iloc[:, 0]], axis=1), axis=1), np.max(
-            pd.concat([features_network_from.iloc[:, 1], features_network_to.iloc[:, 1]], axis=1), axis=1)], axis=1)
-        features_pagerank_paper = data.get_batch(0, data.data_train.shape[0], "train", get_item="pagerank_paper")
-        features_pagerank_paper = pd.concat([features_pagerank_paper, np.max(features_pagerank_paper, axis=1)], axis=1)
-        features_meanAciteB = data.get_batch(0, data.data_train.shape[0], "train", get_item="mean_aciteb")
-        features_pagerank_author = data.get_batch(0, data.data_train.shape[0], "train", get_item="pagerank_author")
-        features_pagerank_author = pd.concat([features_pagerank_author, np.max(features_pagerank_author, axis=1)],
-                                             axis=1)
-        features_adamic_adar_paper = data.get_batch(0, data.data_train.shape[0], "train", get_item="adamic_adar_paper")
-        features_dyear = data.get_batch(0, data.data_train.shape[0], "train", get_item="dyear")
-        features_author_overlap = data.get_batch(0, data.data_train.shape[0], "train", get_item="author_overlap")
-        print(time.clock() - t0)
-
-        features_node.to_csv("features_node")
-        features_network_from.to_csv("features_network_from")
-        features_network_to.to_csv("features_network_to")
-        features_network.to_csv("features_network")
-        features_pagerank_paper.to_csv("features_pagerank_paper")
-        features_meanAciteB.to_csv("features_meanAciteB")
-        features_pagerank_author.to_csv("features_pagerank_author")
-        features_adamic_adar_paper.to_csv("features_adamic_adar_paper")
-        features_dyear.to_csv("features_dyear")
-        features_author_overlap.to_csv("features_author_overlap")
-
-        t0 = time.clock()
-        test_features_node = data.get_batch(0, data.data_test.shape[0], "test", get_item="node")
-        test_features_network_from = data.get_batch(0, data.data_test.shape[0], "test", get_item="network_jaccard_from")
-        test_features_network_to = data.get_batch(0, data.data_test.shape[0], "test", get_item="network_jaccard_to")
-        test_features_network = pd.concat([test_features_network_from, test_features_network_to, np.max(
-            pd.concat([test_features_network_from.iloc[:, 0], test_features_network_to.iloc[:, 0]], axis=1), axis=1),
-                                           np.max(pd.concat([test_features_network_from.iloc[:, 1],
-                                                             test_features_network_to.iloc[:, 1]], axis=1), axis=1)],
-                                          axis=1)
-        test_features_pagerank_paper = data.get_batch(0, data.data_test.shape[0], "test", get_item="pagerank_paper")
-        test_features_pagerank_paper = pd.concat(
-            [test_features_pagerank_paper, np.max(test_features_pagerank_paper, axis=1)], axis=1)
-        test_features_meanAciteB = data.get_batch(0, data.data_test.shape[0], "test", get_item="mean_aciteb")
-        test_features_pagerank_author = data.get_batch(0, data.data_test.shape[0], "test", get_item="pagerank_author")
-        test_features_pagerank_author = pd.concat(
-            [test_features_pagerank_author, np.max(test_features_pagerank_author, axis=1)], axis=1)
-        test_features_adamic_adar_paper = data.get_batch(0, data.data_test.shape[0], "test",
-                                                         get_item="adamic_adar_paper")
-        test_features_dyear = data.get_batch(0, data.data_test.shape[0], "test", get_item="dyear")
-        test_features_author_overlap = data.get_batch(0, data.data_test.shape[0], "test", get_item="author_overlap")
-        print(time.clock() - t0)
-
-        test_features_node.to_csv("test_features_node")
-        test_features_network_from.to_csv("test_features_network_from")
-        test_features_network_to.to_csv("test_features_network_to")
-        test_features_network.to_csv("test_features_network")
-        test_features_pagerank_paper.to_csv("test_features_pagerank_paper")
-        test_features_meanAciteB.to_csv("test_features_meanAciteB")
-        test_features_pagerank_author.to_csv("test_features_pagerank_author")
-        test_features_adamic_adar_paper.to_csv("test_features_adamic_adar_paper")
-        test_features_dyear.to_csv("test_features_dyear")
-        test_features_author_overlap.to_csv("test_features_author_overlap")
-
-    else:
-        t0 = time.clock()
-        # -------- features_node --------
-        # 0.  jaccard_tkzd_title
-        # 1.  dice_tkzd_title
-        # 2.  jaccard_tkzd_abstract
-        # 3.  jaccard_bigr_tkzd_abstract
-        # 4.  jaccard_trigr_tkzd_abstract
-        # 5.  dice_tkzd_abstract
-        # 6.  dice_bigr_tkzd_abstract
-        # 7.  dice_trigr_tkzd_abstract
-        # 8.  jaccard_tkzd_abstract_rm_stpwds
-        # 9.  jaccard_bigr_tkzd_abstract_rm_stpwds
-        # 10. jaccard_trigr_tkzd_abstract_rm_stpwds
-        # 11. dice_tkzd_abstract_rm_stpwds
-        # 12. dice_bigr_tkzd_abstract_rm_stpwds
-        # 13. dice_trigr_tkzd_abstract_rm_stpwds
-        features_node = pd.read_csv("features_node", header=0, index_col=0)  # 14 columns
-
-        # -------- features_pagerank_paper --------
-        # 14. pagerank_paper_from
-        # 15. pagerank_paper_to
-        # 16. pagerank_paper_max
-        features_pagerank_paper = pd.read_csv("features_pagerank_paper", header=0, index_col=0)  # 3 columns
-
-        # -------- features_meanAciteB --------
-        # 17. meanAciteB
-        # 18. maxAciteB
-        # 19. sumAciteB
-        # 20. meanBciteA
-        # 21. maxBciteA
-        # 22. sumBciteA
-        # 23. maxmeancite
-        # 24. maxmaxcite
-        # 25. maxsumcite
-        # 26. meanAciteB_all
-        # 27. maxAciteB_all
-        # 28. sumAciteB_all
-        features_meanAciteB = pd.read_csv("features_meanAciteB", header=0, index_col=0)  # 12 columns
-
-        # -------- features_pagerank_author --------
-        # 29. author_pagerank_mean_from
-        # 30. author_pagerank_mean_to
-        # 31. author_pagerank_max_from
-        # 32. author_pagerank_max_to
-        # 33. author_pagerank_max_max
-        features_pagerank_author = pd.read_csv("features_pagerank_author", header=0, index_col=0)  # 5 columns
-
-        # -------- features_adamic_adar_paper --------
-        # 34. adamic_adar_paper
-        features_adamic_adar_paper = pd.read_csv("features_adamic_adar_paper", header=None, index_col=0)  # 1 column
-
-        # -------- features_dyear --------
-        # 35. dyear
-        features_dyear = pd.read_csv("features_dyear", header=None, index_col=0)  # 1 column
-
-        # -------- features_author_overlap --------
-        # 36. author_overlap
-        features_author_overlap = pd.read_csv("features_author_overlap", header=None, index_col=0)  # 1 column
-
-        # -------- features_network --------
-        # 37. network_from_mean
-        # 38. network_from_sum
-        # 39. network_to_mean
-        # 40. network_to_sum
-        # 41. network_to_mean_max
-        # 42. network_to_sum_max
-        features_network = pd.read_csv("features_network", header=0, index_col=0)  # 6 columns
-
-        test_features_node = pd.read_csv("test_features_node", header=0, index_col=0)
-        test_features_pagerank_paper = pd.read_csv("test_features_pagerank_paper", header=0, index_col=0)
-        test_features_meanAciteB = pd.read_csv("test_features_meanAciteB", header=0, index_col=0)
-        test_features_pagerank_author = pd.read_csv("test_features_pagerank_author", header=0, index_col=0)
-        test_features_adamic_adar_paper = pd.read_csv("test_features_adamic_adar_paper", header=None, index_col=0)
-        test_features_dyear = pd.read_csv("test_features_dyear", header=None, index_col=0)
-        test_features_author_overlap = pd.read_csv("test_features_author_overlap", header=None, index_col=0)
-        test_features_network = pd.read_csv("test_features_network", header=0, index_col=0)
-        print(time.clock() - t0)
-
-    features_network[np.isnan(features_network)] = 0
-    test_features_network[np.isnan(test_features_network)] = 0
-
-    training_features = pd.concat(
-        [features_node, features_pagerank_paper, features_meanAciteB, features_pagerank_author,
-         features_adamic_adar_paper, features_dyear, features_author_overlap, features_network], axis=1)
+    feature_store = FeatureStore(FEATURE_DIR, FEATURE_FAMILIES)
+
+    # only the families whose inputs changed, and only for pairs not in the store yet, are computed
+    for data_set in ["train", "test"]:
+        data_frame = data.data_train if data_set == "train" else data.data_test
+        feature_store.align(data_set, data.get_pairs(data_set), data_frame.index)
+    feature_keys = {family: data.get_feature_key(family) for family, _ in FEATURE_FAMILIES}
+    todo = []
+    for data_set in ["train", "test"]:
+        for family, _ in FEATURE_FAMILIES:
+            if FORCE_RECOMPUTE:
+                rows = np.arange(data.data_train.shape[0] if data_set == "train" else data.data_test.shape[0])
+            else:
+                rows = feature_store.missing(data_set, family, feature_keys[family])
+            if len(rows):
+                todo.append((data_set, family, rows))
+
+    if todo:
+
+        data.prepare(SNAPSHOT_DIR)
+
+        t0 = time.time()
+        # graph families of training pairs come out of fold, all of them on one masking of every fold
+        oof = [(family, rows) for data_set, family, rows in todo
+               if data_set == "train" and family in GRAPH_FAMILIES and GRAPH_FOLDS > 1]
+        if oof:
+            print("computing %s features of training pairs out of fold" % ", ".join(family for family, _ in oof))
+            for family, features in data.get_families_oof(oof).items():
+                feature_store.save("train", family, features, feature_keys[family], rows=dict(oof)[family])
+        for data_set, family, rows in todo:
+            if data_set == "train" and family in dict(oof):
+                continue
+            print("computing %s features of %d %s pairs" % (family, len(rows), data_set))
+            features = data.get_family(data_set, family, rows=rows)
+            feature_store.save(data_set, family, features, feature_keys[family], rows=rows)
+        print(time.time() - t0)
+
+    # all columns (see FEATURE_FAMILIES), memory-mapped from FEATURE_DIR
+    t0 = time.time()
+    training_features = feature_store.load("train")
+    testing_features = feature_store.load("test")
+    print(time.time() - t0)
 
     # training_features = training_features.iloc[:, [i for i in range(43) if i not in (
     # 19, 22, 25, 28, 37, 38, 39, 40, 41, 42)]]  # weights 1 (n_estimators=50)
     # training_features = training_features.iloc[:, [i for i in range(43) if i not in (
     # 19, 22, 25, 28, 37, 38, 39, 40, 41, 42, 5, 6, 7, 10, 13, 18, 32)]]  # weights 2 (n_estimators=7)
 
-    training_features = training_features.iloc[:,
-                        [0, 2, 3, 8, 9, 14, 15, 16, 17, 18, 20, 21, 23, 24, 26, 29, 30, 31, 33, 34, 35, 37, 38, 39, 40,
-                         41, 42]]  # select important features
+    training_features = training_features.iloc[:, SELECTED_FEATURES]
+    training_features = training_features.fillna(0)  # empty neighbourhoods of the network features
 
     training_index = training_features.index
-    training_features = preprocessing.scale(training_features)
+    scaler = preprocessing.StandardScaler().fit(training_features)  # kept to scale streamed candidates alike
+    training_features = scaler.transform(training_features)
     labels_array = data.data_train["predict"][training_index]
 
-    testing_features = pd.concat(
-        [test_features_node, test_features_pagerank_paper, test_features_meanAciteB, test_features_pagerank_author,
-         test_features_adamic_adar_paper, test_features_dyear, test_features_author_overlap, test_features_network],
-        axis=1)
-
     # testing_features = testing_features.iloc[:, [i for i in range(43) if i not in (
     # 19, 22, 25, 28, 37, 38, 39, 40, 41, 42)]]  # weights 1 (n_estimators=50)
     # testing_features = testing_features.iloc[:, [i for i in range(43) if i not in (
     # 19, 22, 25, 28, 37, 38, 39, 40, 41, 42, 5, 6, 7, 10, 13, 18, 32)]]  # weights 2 (n_estimators=7)
 
-    testing_features = testing_features.iloc[:,
-                       [0, 2, 3, 8, 9, 14, 15, 16, 17, 18, 20, 21, 23, 24, 26, 29, 30, 31, 33, 34, 35, 37, 38, 39, 40,
-                        41, 42]]  # select important features
+    testing_features = testing_features.iloc[:, SELECTED_FEATURES]
+    testing_features = testing_features.fillna(0)
 
-    testing_features = preprocessing.scale(testing_features)
+    testing_features = scaler.transform(testing_features)  # training statistics, as streamed and served pairs
 
     basemodel_1 = xgb.XGBClassifier(learning_rate=0.1, n_estimators=7, max_depth=5, min_child_weight=1, seed=0,
                                     subsample=0.8, colsample_bytree=0.8, gamma=0, reg_alpha=0, reg_lambda=1,
@@ -833,9 +1201,15 @@ if __name__ == '__main__':
 
         stacker = xgb.XGBClassifier(n_estimators=2, n_jobs=-1, subsample=0.8)
         ensemble = Ensemble(n_folds=5, stacker=stacker,
-                            base_models=[basemodel_1, basemodel_2, basemodel_3, basemodel_4, basemodel_5])
+                            base_models=[basemodel_1, basemodel_2, basemodel_3, basemodel_4, basemodel_5],
+                            early_stopping_rounds=EARLY_STOPPING_ROUNDS, keep_models=SAVE_BUNDLE)
         ans, s_train, s_test = ensemble.fit_predict(X_train, y_train, X_test)
 
+        if SAVE_BUNDLE:
+            bundle_utils.ModelBundle(ensemble.stacker, SELECTED_FEATURES, scaler,
+                                     threshold=ensemble.threshold, base_models=ensemble.fold_models,
+                                     feature_names=feature_store.columns, feature_keys=feature_keys).save(BUNDLE_DIR)
+
         if SUBMIT:
             predict = pd.read_csv(PREDICT, sep=",")
             predict["prediction"] = ans
@@ -847,7 +1221,7 @@ if __name__ == '__main__':
             plot_importance(ensemble.stacker)
             plt.show()
 
-            ans_train = ensemble.stacker.predict(s_train)
+            ans_train = (model_utils._predict_score(ensemble.stacker, s_train) >= ensemble.threshold).astype(int)
             f1_train = f1_score(ans_train, y_train)
             print("F1 accuracy of training: %.10f" % f1_train)
             # calculate f1
@@ -878,37 +1252,61 @@ if __name__ == '__main__':
                                 'subsample': 0.8, 'colsample_bytree': 0.8, 'gamma': 0, 'reg_alpha': 0, 'reg_lambda': 1,
                                 'objective': "binary:logistic"}
 
-            model = xgb.XGBClassifier(**other_params)
-            optimized_GBM = GridSearchCV(estimator=model, param_grid=cv_params, scoring='f1', cv=5, verbose=1,
-                                         n_jobs=-1)
-            optimized_GBM.fit(X_train, y_train)
-            evalute_result = optimized_GBM.grid_scores_
-            print('evalute result:{0}'.format(evalute_result))
-            print('best params: {0}'.format(optimized_GBM.best_params_))
-            print('best score: {0}'.format(optimized_GBM.best_score_))
+            # successive halving instead of the full grid, resumed from the trial log of an interrupted search
+            search = tuning_utils.SuccessiveHalving(other_params, cv_params, X_train, y_train, n_folds=5,
+                                                    eta=TUNING_ETA, min_fraction=TUNING_MIN_FRACTION,
+                                                    resource=TUNING_RESOURCE, path=TUNING_DIR)
+            best_params, best_score = search.run()
+            print('evalute result:{0}'.format(sorted(search.trials.values(), key=lambda trial: -trial["score"])))
+            print('best params: {0}'.format(best_params))
+            print('best score: {0}'.format(best_score))
         else:
             # train model
             model = basemodel_1
-
-            if SUBMIT:
+            threshold = 0.5
+
+            if EARLY_STOPPING_ROUNDS:
+                # boost until a held-out part of the training set stalls, its probabilities tune the f1 threshold
+                model = clone(basemodel_1).set_params(n_estimators=MAX_BOOST_ROUNDS)
+                X_fit, X_valid, y_fit, y_valid = train_test_split(X_train, y_train, test_size=VALID_SIZE,
+                                                                  random_state=0)
+                model_utils._fit_early_stopping(model, X_fit, y_fit, X_valid, y_valid, EARLY_STOPPING_ROUNDS)
+                threshold, f1_valid = model_utils._best_f1_threshold(y_valid,
+                                                                     model_utils._predict_score(model, X_valid))
+                print("best round: %d, threshold: %.6f, F1 of the held-out part: %.10f"
+                      % (model.best_iteration, threshold, f1_valid))
+            elif SUBMIT:
                 model.fit(X_train, y_train)
             else:
                 model.fit(X_train, y_train, eval_set=[(X_train, y_train), (X_test, y_test)], eval_metric="error")
 
+            if SAVE_BUNDLE:
+                bundle_utils.ModelBundle(model, SELECTED_FEATURES, scaler, threshold=threshold,
+                                         feature_names=feature_store.columns,
+                                         feature_keys=feature_keys).save(BUNDLE_DIR)
+
             # show importance
             plot_importance(model)
             plt.show()
 
             # test
-            ans = model.predict(X_test)
+            ans = (model_utils._predict_score(model, X_test) >= threshold).astype(int)
 
             if SUBMIT:
                 predict = pd.read_csv(PREDICT, sep=",")
                 predict["prediction"] = ans
                 predict.to_csv("prediction", index=False)
 
+                if STREAM_SCORING:
+                    data.score_stream(DIR_CANDIDATES, model, STREAM_OUTPUT, SELECTED_FEATURES, scaler,
+                                      threshold=threshold)
+                if RECOMMEND:
+                    query_ids = pd.read_csv(DIR_QUERIES, names=["id"], header=None)["id"].values
+                    recommendations = data.recommend(query_ids, model, SELECTED_FEATURES, scaler)
+                    recommendations.to_csv(RECOMMEND_OUTPUT, index=False)
+
             else:
-                ans_train = model.predict(X_train)
+                ans_train = (model_utils._predict_score(model, X_train) >= threshold).astype(int)
                 f1_train = f1_score(ans_train, y_train)
                 print("F1 accuracy of training: %.10f" % f1_train)
                 # calculate f1
@@ -0,0 +1,178 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: local prediction server: keeps the node store, the graphs and a model bundle resident and answers
+        link probability requests over HTTP, on localhost or a Unix socket
+
+    POST /predict  {"id_source": 1, "id_target": 2} or {"pairs": [[1, 2], [3, 4], ...]}
+                -> {"probability": [...], "prediction": [...]}
+    GET /health -> {"status": "ok", "pairs": pairs scored so far}
+"""
+
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import model
+from utils.bundle_utils import ModelBundle
+
+# -----------------------
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_SOCKET = None  # path of a Unix socket to listen on instead of SERVER_HOST:SERVER_PORT
+BATCH_WAIT = 0.002  # seconds the batcher waits for more requests once one arrived
+MAX_BATCH = 10000  # pairs scored in one pass at most
+# -----------------------
+
+
+class PairBatcher(object):
+    # scores the pairs of concurrent requests together: request threads queue their pairs and wait, a single
+    # worker thread takes everything queued (up to max_batch pairs, waiting max_wait seconds for more after
+    # the first request) and runs one pass over the feature families and the model for all of them
+
+    def __init__(self, data, bundle, max_batch=MAX_BATCH, max_wait=BATCH_WAIT):
+        self.data = data
+        self.bundle = bundle
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.n_pairs = 0
+        self.requests = queue.Queue()
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def get_proba(self, pairs):
+        # link probabilities of the pairs (n x 2 paper ids), features computed in process (no forking) and only
+        # for the families the bundle selects columns of
+        features = self.data.get_pair_features(pd.DataFrame(pairs, columns=["id_source", "id_target"]), n_jobs=1,
+                                               columns=self.bundle.columns)
+        return self.bundle.predict_proba(features)
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_pairs = len(batch[0]["pairs"])
+            deadline = time.time() + self.max_wait
+            while n_pairs < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_pairs += len(request["pairs"])
+            try:
+                proba = self.get_proba(np.concatenate([request["pairs"] for request in batch], axis=0))
+                bounds = np.cumsum([0] + [len(request["pairs"]) for request in batch])
+                for k, request in enumerate(batch):
+                    request["proba"] = proba[bounds[k]: bounds[k + 1]]
+                self.n_pairs += n_pairs
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+    def score(self, pairs):
+        """link probabilities of pairs, scored together with whatever other requests are queued"""
+        request = {"pairs": pairs, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["proba"]
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # keep-alive, a client sending many requests reuses its connection
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": "unknown path %s" % self.path})
+        self.send_json(200, {"status": "ok", "pairs": self.server.batcher.n_pairs})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self.send_json(404, {"error": "unknown path %s" % self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            if "pairs" in body:
+                pairs = np.asarray(body["pairs"], dtype=np.int64).reshape(-1, 2)
+            else:
+                pairs = np.array([[body["id_source"], body["id_target"]]], dtype=np.int64)
+            # unknown papers fail this request only, not the batch it would join
+            self.server.batcher.data.node_store.rows(pairs.ravel())
+        except (ValueError, KeyError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        try:
+            proba = self.server.batcher.score(pairs)
+        except Exception as e:
+            return self.send_json(500, {"error": str(e)})
+        self.send_json(200, {"probability": proba.tolist(),
+                             "prediction": (proba >= self.server.batcher.bundle.threshold).astype(int).tolist()})
+
+    def log_message(self, format, *args):
+        # no line per request, a Unix socket client has no address to log either
+        pass
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def load_data():
+    # the node store and graphs of model.py's training run, from its snapshot
+    data = model.Data(sample=True)
+    data.load_data()
+    data.sample(prop=1, load=model.LOAD_SAMPLE)
+    data.prepare(model.SNAPSHOT_DIR)
+    return data
+
+
+def make_server(data, bundle, host=SERVER_HOST, port=SERVER_PORT, socket_path=SERVER_SOCKET):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, PredictionHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), PredictionHandler)
+        server.daemon_threads = True
+    server.batcher = PairBatcher(data, bundle)
+    return server
+
+
+if __name__ == '__main__':
+    bundle = ModelBundle.load(model.BUNDLE_DIR)
+    data = load_data()
+    bundle.check_features([name for _, names in model.FEATURE_FAMILIES for name in names],
+                          {family: data.get_feature_key(family) for family, _ in model.FEATURE_FAMILIES})
+
+    server = make_server(data, bundle)
+    # lazily built state (n-gram matrices, tf-idf vectors, centralities) is built before the first request
+    t0 = time.time()
+    first_id = data.node_store.ids[0]
+    server.batcher.score(np.array([[first_id, first_id]], dtype=np.int64))
+    print("warm in %.2f sec" % (time.time() - t0))
+
+    print("serving on %s" % (SERVER_SOCKET or "http://%s:%d" % (SERVER_HOST, SERVER_PORT)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if SERVER_SOCKET is not None and os.path.exists(SERVER_SOCKET):
+            os.remove(SERVER_SOCKET)
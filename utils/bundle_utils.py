@@ -0,0 +1,94 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: model bundle: a fitted model with the feature columns, scaling and threshold it was trained with
+"""
+
+import json
+import os
+import pickle
+import sys
+
+import numpy as np
+
+from utils import model_utils
+sys.path.append("..")
+
+BUNDLE_VERSION = 1
+
+
+class ModelBundle(object):
+    # everything needed to score raw feature rows (all columns of FEATURE_FAMILIES) like the training rows:
+    # the selected columns, the fitted StandardScaler, the model and its decision threshold. For a stacked
+    # ensemble, model is the stacker and base_models the fitted first layer, one list of fold models per base
+    # model whose mean prediction is a column of the stacker's input.
+    # On disk: manifest.json (columns, scaler statistics, threshold, feature cache keys) and models.pkl with the
+    # model(s) and the scaler
+
+    def __init__(self, model, columns, scaler, threshold=0.5, base_models=None, feature_names=None,
+                 feature_keys=None):
+        # feature_names: all feature columns, feature_keys: {family: `Data.get_feature_key`} of the training
+        # features, both checked against the features a bundle is later applied to
+        self.model = model
+        self.columns = [int(column) for column in columns]
+        self.scaler = scaler
+        self.threshold = float(threshold)
+        self.base_models = base_models
+        self.feature_names = list(feature_names) if feature_names is not None else None
+        self.feature_keys = dict(feature_keys) if feature_keys is not None else None
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest["version"] != BUNDLE_VERSION:
+            raise ValueError("bundle version %s in %s, expected %d" % (manifest["version"], path, BUNDLE_VERSION))
+        with open(os.path.join(path, "models.pkl"), "rb") as f:
+            models = pickle.load(f)
+        return cls(models["model"], manifest["columns"], models["scaler"], threshold=manifest["threshold"],
+                   base_models=models["base_models"], feature_names=manifest["feature_names"],
+                   feature_keys=manifest["feature_keys"])
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "models.pkl"), "wb") as f:
+            pickle.dump({"model": self.model, "base_models": self.base_models, "scaler": self.scaler}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        manifest = {"version": BUNDLE_VERSION, "columns": self.columns, "mean": self.scaler.mean_.tolist(),
+                    "scale": self.scaler.scale_.tolist(), "threshold": self.threshold,
+                    "feature_names": self.feature_names, "feature_keys": self.feature_keys,
+                    "model": type(self.model).__name__,
+                    "base_models": None if self.base_models is None else
+                    [type(fold_models[0]).__name__ for fold_models in self.base_models]}
+        # the manifest last, a bundle without one is incomplete
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+    def check_features(self, feature_names, feature_keys=None):
+        """raise if features named feature_names (computed with the cache keys feature_keys) are not the ones
+        the bundle was trained on"""
+        if self.feature_names is not None and list(feature_names) != self.feature_names:
+            raise ValueError("feature columns differ from the bundle's")
+        if self.feature_keys is not None and feature_keys is not None:
+            changed = sorted(family for family, key in self.feature_keys.items() if feature_keys.get(family) != key)
+            if changed:
+                raise ValueError("features computed differently from the bundle's: %s" % ", ".join(changed))
+
+    def transform(self, features):
+        """selected columns of a float32 frame of all feature columns (see `Data.get_pair_features`), missing
+        values as 0, scaled as the training rows"""
+        return self.scaler.transform(features.iloc[:, self.columns].fillna(0))
+
+    def predict_proba(self, features):
+        """link probability of every row of a frame of all feature columns"""
+        if features.shape[0] == 0:
+            # sklearn scalers and models refuse zero rows
+            return np.zeros(0)
+        features = self.transform(features)
+        if self.base_models is not None:
+            features = np.column_stack([np.mean([model_utils._predict_score(clf, features) for clf in fold_models],
+                                                axis=0) for fold_models in self.base_models])
+        return model_utils._predict_score(self.model, features)
+
+    def predict(self, features):
+        return (self.predict_proba(features) >= self.threshold).astype(int)
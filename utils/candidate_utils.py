@@ -0,0 +1,53 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for bounded candidate generation with sparse row products instead of an all-pairs scan
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from utils import graph_utils
+sys.path.append("..")
+
+
+def _membership(values, offsets, n_columns):
+    """binary CSR matrix (rows x ids) of a flattened (values, offsets) id-list column"""
+    matrix = sparse.csr_matrix((np.ones(len(values), dtype=np.int32), np.asarray(values, dtype=np.int64),
+                                np.asarray(offsets, dtype=np.int64)), shape=(len(offsets) - 1, n_columns))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def _top_candidates(left, right, queries, max_candidates, exclude=None, chunk_size=1000):
+    """(query position, candidate, score) of the max_candidates highest scores of every row of
+    left[queries].dot(right), leaving out the query itself and the nonzero columns of its row in exclude.
+    Ties go to the lower candidate; queries are processed chunk_size at a time"""
+    queries = np.asarray(queries, dtype=np.int64)
+    out_positions = []
+    out_candidates = []
+    out_scores = []
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start: start + chunk_size]
+        scores = left[chunk].dot(right).tocsr()
+        scores.sum_duplicates()
+        positions = np.repeat(np.arange(len(chunk)), np.diff(scores.indptr))
+        candidates = scores.indices.astype(np.int64)
+        values = scores.data
+        keep = (candidates != chunk[positions]) & (values > 0)
+        if exclude is not None:
+            keep &= graph_utils._gather(exclude, chunk[positions], candidates) == 0
+        positions, candidates, values = positions[keep], candidates[keep], values[keep]
+
+        order = np.lexsort((candidates, -values, positions))
+        positions, candidates, values = positions[order], candidates[order], values[order]
+        rank = np.arange(len(positions)) - np.searchsorted(positions, positions)
+        keep = rank < max_candidates
+        out_positions.append(positions[keep] + start)
+        out_candidates.append(candidates[keep])
+        out_scores.append(values[keep])
+    if not out_positions:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.concatenate(out_positions), np.concatenate(out_candidates), np.concatenate(out_scores)
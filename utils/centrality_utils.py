@@ -0,0 +1,114 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for node centralities of a sparse directed graph, computed once and gathered per pair
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from utils import graph_utils, np_utils
+sys.path.append("..")
+
+
+def _pagerank(adjacency, damping=0.85, reset=None, tol=1e-12, max_iter=1000):
+    """pagerank of a directed CSR adjacency (edge multiplicities as weights), as igraph Graph.pagerank();
+    random jumps and dangling nodes go uniformly to all nodes, or by the distribution `reset` if given
+    (personalized pagerank)"""
+    n_nodes = adjacency.shape[0]
+    if n_nodes == 0:
+        return np.zeros(0)
+    if reset is None:
+        reset = np.full(n_nodes, 1.0 / n_nodes)
+    else:
+        reset = np_utils._try_divide_array(np.asarray(reset, dtype=np.float64), np.sum(reset))
+    out_weight = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = out_weight == 0
+    transition = sparse.diags(np_utils._try_divide_array(1.0, out_weight)).dot(adjacency).T.tocsr()
+    rank = np.full(n_nodes, 1.0 / n_nodes)
+    for _ in range(max_iter):
+        new_rank = damping * (transition.dot(rank) + rank[dangling].sum() * reset) + (1.0 - damping) * reset
+        new_rank /= new_rank.sum()
+        if np.abs(new_rank - rank).sum() < tol:
+            return new_rank
+        rank = new_rank
+    return rank
+
+
+def _degrees(adjacency):
+    """weighted in and out degree of a directed CSR adjacency"""
+    in_degree = np.asarray(adjacency.sum(axis=0), dtype=np.float64).ravel()
+    out_degree = np.asarray(adjacency.sum(axis=1), dtype=np.float64).ravel()
+    return in_degree, out_degree
+
+
+def _hits(adjacency, tol=1e-10, max_iter=1000):
+    """hub and authority scores of a directed CSR adjacency, each scaled to a maximum of 1,
+    as igraph Graph.hub_score() and Graph.authority_score()"""
+    n_nodes = adjacency.shape[0]
+    adjacency_t = adjacency.T.tocsr()
+    hub = np.ones(n_nodes)
+    for _ in range(max_iter):
+        new_hub = adjacency.dot(adjacency_t.dot(hub))
+        scale = new_hub.max() if n_nodes else 0
+        if scale == 0:
+            return np.zeros(n_nodes), np.zeros(n_nodes)
+        new_hub /= scale
+        converged = np.abs(new_hub - hub).sum() < tol
+        hub = new_hub
+        if converged:
+            break
+    authority = adjacency_t.dot(hub)
+    return hub, authority / authority.max()
+
+
+class Centrality(object):
+    # centralities of one directed graph, each computed on first use and kept; build the ones a batch
+    # needs with `compute` before forking workers so they share the arrays
+    MEASURES = ("pagerank", "personalized_pagerank", "in_degree", "out_degree", "hub", "authority")
+
+    def __init__(self, adjacency, reset=None):
+        # reset: jump distribution of "personalized_pagerank", e.g. 1 on a set of seed nodes
+        self.adjacency = adjacency
+        self.reset = reset
+        self.scores = {}
+
+    def compute(self, measures):
+        for measure in measures:
+            self.get(measure)
+
+    def get(self, measure):
+        if measure not in self.scores:
+            if measure == "pagerank":
+                self.scores[measure] = _pagerank(self.adjacency)
+            elif measure == "personalized_pagerank":
+                if self.reset is None:
+                    raise ValueError("personalized_pagerank needs a reset distribution")
+                self.scores[measure] = _pagerank(self.adjacency, reset=self.reset)
+            elif measure in ("in_degree", "out_degree"):
+                self.scores["in_degree"], self.scores["out_degree"] = _degrees(self.adjacency)
+            elif measure in ("hub", "authority"):
+                self.scores["hub"], self.scores["authority"] = _hits(self.adjacency)
+            else:
+                raise KeyError("unknown centrality %s, expected one of %s" % (measure, ", ".join(self.MEASURES)))
+        return self.scores[measure]
+
+    def pair_features(self, measures, rows_from, rows_to):
+        """(from, to) score of every pair for every measure, columns measure by measure"""
+        columns = []
+        for measure in measures:
+            scores = self.get(measure)
+            columns.extend([scores[rows_from], scores[rows_to]])
+        return np.column_stack(columns) if columns else np.zeros((len(rows_from), 0))
+
+    def group_features(self, measures, positions, nodes_from, nodes_to, n_groups):
+        """mean from, mean to, max from and max to score over the (from node, to node) rows of every group,
+        as `graph_utils._cartesian_pairs` gives them; 0 for empty groups. Columns measure by measure"""
+        columns = []
+        for measure in measures:
+            scores = self.get(measure)
+            mean_from, max_from, _ = graph_utils._group_stats(positions, scores[nodes_from], n_groups)
+            mean_to, max_to, _ = graph_utils._group_stats(positions, scores[nodes_to], n_groups)
+            columns.extend([mean_from, mean_to, max_from, max_to])
+        return np.column_stack(columns) if columns else np.zeros((n_groups, 0))
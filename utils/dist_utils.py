@@ -13,10 +13,21 @@ try:
 except:
     pass
 
+import numpy as np
+
 from utils import np_utils
 sys.path.append("..")
 
+
+def _sorted_intersection_size(A, B):
+    """size of the intersection of two sorted arrays of unique ids"""
+    return np.intersect1d(A, B, assume_unique=True).shape[0]
+
+
 def _jaccard_coef(A, B):
+    if isinstance(A, np.ndarray) and isinstance(B, np.ndarray):
+        inter = _sorted_intersection_size(A, B)
+        return np_utils._try_divide(float(inter), len(A) + len(B) - inter)
     if not isinstance(A, set):
         A = set(A)
     if not isinstance(B, set):
@@ -25,6 +36,9 @@ def _jaccard_coef(A, B):
 
 
 def _dice_dist(A, B):
+    if isinstance(A, np.ndarray) and isinstance(B, np.ndarray):
+        inter = _sorted_intersection_size(A, B)
+        return np_utils._try_divide(2.*float(inter), (len(A) + len(B)))
     if not isinstance(A, set):
         A = set(A)
     if not isinstance(B, set):
@@ -0,0 +1,166 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: columnar on-disk store of the feature matrices, cached per feature family
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("..")
+
+
+def _file_md5(path, block_size=1 << 20):
+    """md5 of a file's content"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _pair_positions(old_pairs, new_pairs):
+    """position of every row of new_pairs in old_pairs, -1 if absent"""
+    old_index = pd.MultiIndex.from_arrays(list(old_pairs.T))
+    first = ~old_index.duplicated()
+    positions = old_index[first].get_indexer(pd.MultiIndex.from_arrays(list(new_pairs.T)))
+    return np.where(positions >= 0, np.flatnonzero(first)[positions], -1)
+
+
+class FeatureStore(object):
+    # one float32 .npy matrix per data set holding every feature family in its own column block. Next to it:
+    # the pairs of every row (what a row is cached by), the pair index, which rows every family has filled,
+    # and a json manifest of column names and of the cache key each family was computed with
+
+    def __init__(self, path, families):
+        # families: [(family, [column names]), ...] in column order
+        self.path = path
+        self.columns = []
+        self.families = {}
+        self.family_names = []
+        for family, names in families:
+            self.families[family] = (len(self.columns), len(self.columns) + len(names))
+            self.family_names.append(family)
+            self.columns.extend(names)
+        self.manifest = self._read_manifest()
+
+    def _file(self, data_set, kind):
+        return os.path.join(self.path, "%s_%s.npy" % (data_set, kind))
+
+    def _read_manifest(self):
+        manifest_file = os.path.join(self.path, "manifest.json")
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            if manifest["columns"] == self.columns:
+                return manifest
+        # no store yet, or the column layout changed: start over
+        return {"columns": self.columns,
+                "families": {family: list(block) for family, block in self.families.items()},
+                "data_sets": {}}
+
+    def _write_manifest(self):
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(self.manifest, f, indent=2)
+
+    def align(self, data_set, pairs, index):
+        # make the rows of data_set follow `pairs` (one int row per pair, e.g. source, target, label),
+        # keeping the features of every pair already in the store
+        pairs = np.asarray(pairs, dtype=np.int64)
+        index = np.asarray(index, dtype=np.int64)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        entry = self.manifest["data_sets"].get(data_set)
+        matrix_file = self._file(data_set, "features")
+        if entry is not None and os.path.exists(matrix_file):
+            old_pairs = np.load(self._file(data_set, "pairs"))
+            if np.array_equal(old_pairs, pairs):
+                np.save(self._file(data_set, "index"), index)
+                return
+            positions = _pair_positions(old_pairs, pairs)
+            old_matrix = np.load(matrix_file, mmap_mode="r")
+            old_filled = np.load(self._file(data_set, "filled"))
+        else:
+            entry = self.manifest["data_sets"][data_set] = {"keys": {}}
+            positions = np.full(len(pairs), -1, dtype=np.int64)
+
+        kept = positions >= 0
+        tmp_file = matrix_file + ".tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32,
+                                           shape=(len(pairs), len(self.columns)))
+        matrix[:] = np.nan
+        filled = np.zeros((len(pairs), len(self.family_names)), dtype=bool)
+        if kept.any():
+            matrix[kept] = old_matrix[positions[kept]]
+            filled[kept] = old_filled[positions[kept]]
+            del old_matrix
+        matrix.flush()
+        del matrix
+        os.replace(tmp_file, matrix_file)
+
+        np.save(self._file(data_set, "filled"), filled)
+        np.save(self._file(data_set, "pairs"), pairs)
+        np.save(self._file(data_set, "index"), index)
+        entry["n_rows"] = len(pairs)
+        self._write_manifest()
+
+    def has(self, data_set, family):
+        if family not in self.manifest["data_sets"].get(data_set, {}).get("keys", {}):
+            return False
+        return bool(np.load(self._file(data_set, "filled"))[:, self.family_names.index(family)].all())
+
+    def load(self, data_set, families=None):
+        # memory-mapped, read-only DataFrame of the requested families (default: all columns)
+        matrix = np.load(self._file(data_set, "features"), mmap_mode="r")
+        index = self.load_index(data_set)
+        families = list(self.family_names) if families is None else families
+        for family in families:
+            if not self.has(data_set, family):
+                raise KeyError("feature family %s of %s is not complete in the store" % (family, data_set))
+        blocks = [self.families[family] for family in families]
+        if all(blocks[k][1] == blocks[k + 1][0] for k in range(len(blocks) - 1)):
+            # contiguous column block: a view on the memmap, no copy
+            start, stop = blocks[0][0], blocks[-1][1]
+            return pd.DataFrame(matrix[:, start: stop], index=index, columns=self.columns[start: stop], copy=False)
+        columns = [k for start, stop in blocks for k in range(start, stop)]
+        return pd.DataFrame(matrix[:, columns], index=index, columns=[self.columns[k] for k in columns])
+
+    def load_index(self, data_set):
+        return np.load(self._file(data_set, "index"))
+
+    def missing(self, data_set, family, key):
+        # row positions of data_set whose family features are not cached under `key`, run after `align`
+        entry = self.manifest["data_sets"][data_set]
+        filled = np.load(self._file(data_set, "filled"))[:, self.family_names.index(family)]
+        if entry["keys"].get(family) != key:
+            return np.arange(filled.shape[0])
+        return np.flatnonzero(~filled)
+
+    def save(self, data_set, family, features, key, rows=None):
+        # features: Series or DataFrame of one family for the row positions `rows` (default: all rows)
+        start, stop = self.families[family]
+        values = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+        if values.shape[1] != stop - start:
+            raise ValueError("feature family %s has %d columns, expected %d" % (family, values.shape[1], stop - start))
+
+        entry = self.manifest["data_sets"][data_set]
+        column = self.family_names.index(family)
+        filled = np.load(self._file(data_set, "filled"))
+        if entry["keys"].get(family) != key:
+            # computed with other inputs or code: everything cached for this family is stale
+            filled[:, column] = False
+        rows = np.arange(filled.shape[0]) if rows is None else np.asarray(rows)
+
+        matrix = np.lib.format.open_memmap(self._file(data_set, "features"), mode="r+")
+        matrix[rows, start: stop] = values
+        matrix.flush()
+        del matrix
+        filled[rows, column] = True
+        np.save(self._file(data_set, "filled"), filled)
+        entry["keys"][family] = key
+        self._write_manifest()
@@ -0,0 +1,212 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for batch link scores on sparse adjacency matrices
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from utils import np_utils
+sys.path.append("..")
+
+
+def _adjacency(edges, n_nodes):
+    """directed CSR adjacency holding edge multiplicities, edges are (from, to) vertex ids"""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    adjacency = sparse.csr_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(n_nodes, n_nodes))
+    adjacency.sum_duplicates()
+    return adjacency
+
+
+def _undirected(adjacency):
+    """binary neighbour sets and degrees of the undirected view, as igraph neighbors/degree with mode="ALL" """
+    symmetric = (adjacency + adjacency.T).tocsr()
+    degree = np.asarray(symmetric.sum(axis=1)).ravel()
+    neighbours = symmetric.copy()
+    neighbours.data[:] = 1
+    return neighbours, degree
+
+
+def _weighted_common_neighbours(neighbours, rows_a, rows_b, weights, chunk_size=100000):
+    """sum of weights[k, :] over the common neighbours k of rows_a[i] and rows_b[i]"""
+    out = np.zeros((len(rows_a), weights.shape[1]))
+    for start in range(0, len(rows_a), chunk_size):
+        stop = start + chunk_size
+        common = neighbours[rows_a[start:stop]].multiply(neighbours[rows_b[start:stop]]).tocsr()
+        out[start:stop] = common.dot(weights)
+    return out
+
+
+def _link_scores(neighbours, degree, rows_a, rows_b, chunk_size=100000):
+    """common neighbours, adamic adar, resource allocation, preferential attachment and jaccard of every pair"""
+    rows_a = np.asarray(rows_a)
+    rows_b = np.asarray(rows_b)
+    # a common neighbour of two distinct nodes has degree >= 2, degree-1 nodes (only i == j) add nothing
+    log_degree = np.log(np.maximum(degree, 1))
+    weights = np.column_stack([np.ones_like(degree, dtype=np.float64),
+                               np_utils._try_divide_array(1.0, np.where(degree > 1, log_degree, 0.0)),
+                               np_utils._try_divide_array(1.0, degree)])
+    common = _weighted_common_neighbours(neighbours, rows_a, rows_b, weights, chunk_size=chunk_size)
+
+    n_neighbours = np.diff(neighbours.indptr)
+    union = n_neighbours[rows_a] + n_neighbours[rows_b] - common[:, 0]
+    return {"common_neighbours": common[:, 0],
+            "adamic_adar": common[:, 1],
+            "resource_allocation": common[:, 2],
+            "preferential_attachment": degree[rows_a] * degree[rows_b],
+            "jaccard": np_utils._try_divide_array(common[:, 0], union)}
+
+
+def _binary(adjacency):
+    """0/1 copy of a CSR adjacency"""
+    binary = adjacency.tocsr(copy=True)
+    binary.data[:] = 1
+    return binary
+
+
+def _expand_neighbours(adjacency_t, centers):
+    """(pair position, neighbour) for every in-neighbour of every center, in-neighbours read from adjacency_t"""
+    counts = np.diff(adjacency_t.indptr)[centers]
+    positions = np.repeat(np.arange(len(centers)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    neighbours = adjacency_t.indices[np.repeat(adjacency_t.indptr[centers], counts) + offsets]
+    return positions, neighbours
+
+
+def _neighbour_jaccard_flat(adjacency, adjacency_t, centers, others, edge_oc):
+    """jaccard terms of `_neighbour_jaccard` for every (pair, in-neighbour k of the center) row"""
+    positions, neighbours = _expand_neighbours(adjacency_t, centers)
+    keep = neighbours != others[positions]
+    positions = positions[keep]
+    neighbours = neighbours[keep]
+    inter = np.asarray(adjacency[others[positions]].multiply(adjacency[neighbours]).sum(axis=1)).ravel()
+    inter = inter - edge_oc[positions]
+    degree = np.diff(adjacency.indptr)
+    size_a = degree[others[positions]] - edge_oc[positions]
+    size_b = degree[neighbours] - 1
+    return positions, np_utils._try_divide_array(inter, size_a + size_b - inter)
+
+
+def _neighbour_jaccard_hub(adjacency, adjacency_t, center, others, edge_oc, max_cells=10000000):
+    """jaccard terms of `_neighbour_jaccard` for all pairs sharing one hub center, its neighbourhood gathered once"""
+    neighbours = adjacency_t.indices[adjacency_t.indptr[center]: adjacency_t.indptr[center + 1]]
+    hub = adjacency[neighbours]
+    degree = np.diff(adjacency.indptr)
+    size_b = degree[neighbours] - 1
+    positions = []
+    terms = []
+    step = max(max_cells // max(len(neighbours), 1), 1)
+    for start in range(0, len(others), step):
+        chunk = others[start: start + step]
+        inter = hub.dot(adjacency[chunk].T).toarray() - edge_oc[start: start + step]
+        size_a = degree[chunk] - edge_oc[start: start + step]
+        jaccard = np_utils._try_divide_array(inter, size_a + size_b[:, None] - inter)
+        keep = neighbours[:, None] != chunk[None, :]
+        positions.append(np.broadcast_to(np.arange(start, start + len(chunk)), keep.shape)[keep])
+        terms.append(jaccard[keep])
+    return np.concatenate(positions), np.concatenate(terms)
+
+
+def _neighbour_jaccard(adjacency, centers, others, hub_degree=None, chunk_size=1000000, adjacency_t=None):
+    """mean and sum, over the in-neighbours k != other of center, of the jaccard similarity of
+    out(other) - {center} and out(k) - {center}; mean is nan when there is no such k.
+    adjacency is a binary CSR matrix, pass its transpose for the mirrored (in-neighbour) version;
+    adjacency_t is its CSR transpose, computed here if not given.
+    Centers with in-degree >= hub_degree that recur across pairs gather their neighbourhood once."""
+    centers = np.asarray(centers, dtype=np.int64)
+    others = np.asarray(others, dtype=np.int64)
+    if adjacency_t is None:
+        adjacency_t = adjacency.T.tocsr()
+    edge_oc = np.asarray(adjacency[others, centers]).ravel().astype(np.float64)
+    sums = np.zeros(len(centers))
+    counts = np.zeros(len(centers))
+
+    in_degree = np.diff(adjacency_t.indptr)
+    flat = np.ones(len(centers), dtype=bool)
+    if hub_degree is not None and len(centers):
+        hubs, hub_counts = np.unique(centers[in_degree[centers] >= hub_degree], return_counts=True)
+        for center in hubs[hub_counts > 1]:
+            pairs = np.flatnonzero(centers == center)
+            positions, terms = _neighbour_jaccard_hub(adjacency, adjacency_t, center, others[pairs], edge_oc[pairs])
+            sums[pairs] = np.bincount(positions, weights=terms, minlength=len(pairs))
+            counts[pairs] = np.bincount(positions, minlength=len(pairs))
+            flat[pairs] = False
+
+    # remaining pairs, chunked so that one chunk expands to about chunk_size (pair, neighbour) rows
+    flat = np.flatnonzero(flat)
+    expanded = np.cumsum(in_degree[centers[flat]])
+    start = 0
+    while start < len(flat):
+        stop = max(np.searchsorted(expanded, (expanded[start - 1] if start else 0) + chunk_size, side="right"),
+                   start + 1)
+        pairs = flat[start: stop]
+        positions, terms = _neighbour_jaccard_flat(adjacency, adjacency_t, centers[pairs], others[pairs],
+                                                   edge_oc[pairs])
+        sums[pairs] = np.bincount(positions, weights=terms, minlength=len(pairs))
+        counts[pairs] = np.bincount(positions, minlength=len(pairs))
+        start = stop
+
+    means = np.full(len(centers), np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means, sums
+
+
+def _cartesian_pairs(values, offsets, rows_a, rows_b):
+    """(pair position, a, b) for every a in row rows_a[i] and b in row rows_b[i] of a flattened
+    (values, offsets) id-list column, in pair order"""
+    rows_a = np.asarray(rows_a, dtype=np.int64)
+    rows_b = np.asarray(rows_b, dtype=np.int64)
+    size_a = offsets[rows_a + 1] - offsets[rows_a]
+    size_b = offsets[rows_b + 1] - offsets[rows_b]
+    counts = size_a * size_b
+    positions = np.repeat(np.arange(len(rows_a)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    width = size_b[positions]
+    a = values[offsets[rows_a][positions] + local // width]
+    b = values[offsets[rows_b][positions] + local % width]
+    return positions, a, b
+
+
+def _gather(matrix, rows, columns):
+    """matrix[rows[i], columns[i]] for every i, as a flat float array"""
+    if len(rows) == 0:
+        return np.zeros(0)
+    return np.asarray(matrix[rows, columns], dtype=np.float64).ravel()
+
+
+def _group_stats(positions, values, n_groups):
+    """mean, max and sum of values per group, 0 for empty groups"""
+    counts = np.bincount(positions, minlength=n_groups)
+    sums = np.bincount(positions, weights=values, minlength=n_groups)
+    maxs = np.zeros(n_groups)
+    np.maximum.at(maxs, positions, values)
+    return np_utils._try_divide_array(sums, counts), maxs, sums
+
+
+def _pair_folds(sources, targets, n_folds, seed=0):
+    """fold of every (source, target) pair, a stable hash so a pair keeps its fold when pairs are added"""
+    h = (np.asarray(sources, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+         ^ np.asarray(targets, dtype=np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+         ^ np.uint64(seed))
+    h ^= h >> np.uint64(31)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(29)
+    return (h % np.uint64(n_folds)).astype(np.int64)
+
+
+def _remove_edges(adjacency, edges):
+    """adjacency with one occurrence of each of `edges` removed, the base matrix is left untouched"""
+    masked = (adjacency - _adjacency(edges, adjacency.shape[0])).tocsr()
+    masked.eliminate_zeros()
+    return masked
+
+
+def _edge_list(adjacency):
+    """(from, to) edges of a CSR adjacency, an edge repeated by its multiplicity"""
+    counts = np.diff(adjacency.indptr)
+    sources = np.repeat(np.arange(adjacency.shape[0]), counts)
+    repeats = np.asarray(adjacency.data, dtype=np.int64)
+    edges = np.column_stack([np.repeat(sources, repeats), np.repeat(adjacency.indices, repeats)])
+    return edges.tolist()
@@ -0,0 +1,76 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: inverted index from token / n-gram ids to posting lists of rows, for overlap lookups by posting merges
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from utils import candidate_utils, ngram_utils, np_utils
+sys.path.append("..")
+
+
+class InvertedIndex(object):
+    # posting list of every term: the rows holding it, as the CSR matrix postings (terms x rows). Terms whose
+    # idf = log(n_rows / doc_freq) is below min_idf are pruned, they neither count nor have postings
+
+    def __init__(self, matrix, min_idf=None):
+        # matrix: rows x terms, nonzero where a row holds a term (e.g. an n-gram matrix of `ngram_utils`)
+        forward = matrix.tocsr().astype(np.int32)
+        forward.sum_duplicates()
+        forward.data[:] = 1
+        n_rows = forward.shape[0]
+        self.doc_freq = np.bincount(forward.indices, minlength=forward.shape[1])
+        self.idf = np.log(np_utils._try_divide_array(float(n_rows), self.doc_freq, val=1.0))
+        self.kept = self.doc_freq > 0
+        if min_idf is not None:
+            self.kept &= self.idf >= min_idf
+            forward = forward.dot(sparse.diags(self.kept.astype(np.int32))).tocsr()
+            forward.eliminate_zeros()
+        self.forward = forward
+        self.postings = forward.T.tocsr()
+
+    @classmethod
+    def from_ids(cls, values, offsets, n_terms, min_idf=None):
+        # index of a flattened (values, offsets) id-list column, e.g. the tokens or the authors of the node store
+        return cls(candidate_utils._membership(values, offsets, n_terms), min_idf=min_idf)
+
+    def get_postings(self, term):
+        return self.postings.indices[self.postings.indptr[term]: self.postings.indptr[term + 1]]
+
+    def intersection(self, rows_a, rows_b, chunk_size=100000):
+        """number of (kept) terms rows_a[k] and rows_b[k] share"""
+        return ngram_utils._batch_intersection(self.forward, np.asarray(rows_a), np.asarray(rows_b),
+                                               chunk_size=chunk_size)
+
+    def query(self, row, min_shared=1, exclude_self=True):
+        """rows sharing at least min_shared terms with row and how many they share, most shared first"""
+        _, rows, counts = self.query_batch([row], min_shared=min_shared, exclude_self=exclude_self)
+        return rows, counts
+
+    def query_batch(self, rows, min_shared=1, exclude_self=True, chunk_size=1000):
+        """(query position, row, shared terms) of every row sharing at least min_shared terms with a query
+        row, by merging the posting lists of its terms; most shared first per query"""
+        rows = np.asarray(rows, dtype=np.int64)
+        out_positions = []
+        out_rows = []
+        out_counts = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start: start + chunk_size]
+            shared = self.forward[chunk].dot(self.postings).tocsr()
+            positions = np.repeat(np.arange(len(chunk)), np.diff(shared.indptr))
+            matches = shared.indices.astype(np.int64)
+            counts = shared.data.astype(np.int64)
+            keep = counts >= min_shared
+            if exclude_self:
+                keep &= matches != chunk[positions]
+            positions, matches, counts = positions[keep], matches[keep], counts[keep]
+            order = np.lexsort((matches, -counts, positions))
+            out_positions.append(positions[order] + start)
+            out_rows.append(matches[order])
+            out_counts.append(counts[order])
+        if not out_positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(out_positions), np.concatenate(out_rows), np.concatenate(out_counts)
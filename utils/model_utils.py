@@ -0,0 +1,50 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for fitting the link classifiers and thresholding their probabilities
+"""
+
+import sys
+
+import numpy as np
+import xgboost as xgb
+
+from utils import np_utils
+sys.path.append("..")
+
+
+def _best_f1_threshold(y_true, scores):
+    """(threshold, f1) maximizing f1 of the labels scores >= threshold, over every distinct score at once"""
+    y_true = np.asarray(y_true).astype(bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0 or not y_true.any():
+        return 0.5, 0.0
+    order = np.argsort(-scores, kind="mergesort")
+    scores = scores[order]
+    true_positives = np.cumsum(y_true[order])
+    # a threshold at scores[k] predicts every row up to the last one with the same score
+    last = np.r_[scores[1:] != scores[:-1], True]
+    predicted = np.arange(1, len(scores) + 1)[last]
+    true_positives = true_positives[last]
+    f1 = np_utils._try_divide_array(2.0 * true_positives, predicted + y_true.sum())
+    best = np.argmax(f1)
+    return scores[last][best], f1[best]
+
+
+def _predict_score(clf, X):
+    """probability of a link for classifiers, the raw prediction for regressors"""
+    if hasattr(clf, "predict_proba"):
+        return clf.predict_proba(X)[:, 1]
+    return clf.predict(X)
+
+
+def _supports_early_stopping(clf):
+    return isinstance(clf, xgb.XGBModel)
+
+
+def _fit_early_stopping(clf, X, y, X_valid, y_valid, rounds, eval_metric="logloss"):
+    """fit a boosting model until the loss on (X_valid, y_valid) has not improved for `rounds` rounds;
+    later predictions use the best round"""
+    # set on the estimator, xgboost 2 dropped them from fit()
+    clf.set_params(early_stopping_rounds=rounds, eval_metric=eval_metric)
+    clf.fit(X, y, eval_set=[(X_valid, y_valid)], verbose=False)
+    return clf
@@ -0,0 +1,75 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for n-gram encoding and batch set similarity
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+
+from utils import np_utils
+sys.path.append("..")
+
+
+def _ngrams(tokens, n):
+    """same grams as nltk.ngrams, returned as a list of tuples (or tokens for n = 1)"""
+    if n == 1:
+        return list(tokens)
+    return list(zip(*[tokens[k:] for k in range(n)]))
+
+
+def _encode_ngrams(token_lists, n, vocab=None):
+    """encode every row's n-gram set into a binary CSR matrix, rows follow `token_lists`"""
+    if vocab is None:
+        vocab = {}
+    indptr = [0]
+    indices = []
+    for tokens in token_lists:
+        row = set()
+        if isinstance(tokens, list):
+            for gram in _ngrams(tokens, n):
+                row.add(vocab.setdefault(gram, len(vocab)))
+        indices.extend(sorted(row))
+        indptr.append(len(indices))
+    indices = np.asarray(indices, dtype=np.int64)
+    data = np.ones(indices.shape[0], dtype=np.int8)
+    matrix = sparse.csr_matrix((data, indices, np.asarray(indptr, dtype=np.int64)),
+                               shape=(len(indptr) - 1, max(len(vocab), 1)))
+    return matrix, vocab
+
+
+def _row_sizes(matrix):
+    """number of distinct grams per row"""
+    return np.diff(matrix.indptr)
+
+
+def _batch_intersection(matrix, rows_a, rows_b, chunk_size=100000):
+    """size of the set intersection of rows_a[k] and rows_b[k], computed chunk by chunk"""
+    counts = np.zeros(len(rows_a), dtype=np.int64)
+    for start in range(0, len(rows_a), chunk_size):
+        stop = start + chunk_size
+        prod = matrix[rows_a[start:stop]].multiply(matrix[rows_b[start:stop]])
+        counts[start:stop] = np.asarray(prod.sum(axis=1)).ravel()
+    return counts
+
+
+def _batch_jaccard_coef(inter, size_a, size_b):
+    """vectorized dist_utils._jaccard_coef from intersection and set sizes"""
+    union = (size_a + size_b - inter).astype(np.float64)
+    return np_utils._try_divide_array(inter, union)
+
+
+def _batch_dice_dist(inter, size_a, size_b):
+    """vectorized dist_utils._dice_dist from intersection and set sizes"""
+    total = (size_a + size_b).astype(np.float64)
+    return np_utils._try_divide_array(2. * inter, total)
+
+
+def _batch_jaccard_dice(matrix, rows_a, rows_b, chunk_size=100000):
+    """jaccard and dice of the n-gram sets of rows_a[k] and rows_b[k]"""
+    inter = _batch_intersection(matrix, rows_a, rows_b, chunk_size=chunk_size)
+    sizes = _row_sizes(matrix)
+    size_a = sizes[rows_a]
+    size_b = sizes[rows_b]
+    return _batch_jaccard_coef(inter, size_a, size_b), _batch_dice_dist(inter, size_a, size_b)
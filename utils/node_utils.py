@@ -0,0 +1,148 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: columnar, integer-indexed store of the node information
+"""
+
+import itertools
+import sys
+
+import numpy as np
+import pandas as pd
+
+from utils import snapshot_utils, text_utils
+sys.path.append("..")
+
+
+class AuthorIndex(object):
+    # canonical author names interned to dense ids, the authors of paper row k are
+    # values[offsets[k]: offsets[k + 1]], distinct and in order of appearance
+
+    def __init__(self, n_rows=0):
+        self.author_id = {}
+        self.names = []
+        self.values = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(n_rows + 1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, texts):
+        # texts: the raw author field of every row, see `text_utils._split_authors` for the cleanup
+        author_lists = text_utils._split_authors(texts)
+        lengths = author_lists.str.len().fillna(0).values.astype(np.int64)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        names = np.fromiter(itertools.chain.from_iterable(author_lists.dropna().values), dtype=object,
+                            count=lengths.sum())
+        # empty names (e.g. a trailing ",") are no authors
+        keep = names != ""
+        rows, names = rows[keep], names[keep]
+        codes, uniques = pd.factorize(names)
+        ids = self.encode(list(uniques))[codes]
+        # an author listed twice on a paper counts once
+        first = ~pd.DataFrame({"row": rows, "id": ids}).duplicated().values
+        rows, ids = rows[first], ids[first]
+        self.values = ids.astype(np.int32)
+        self.offsets = text_utils._offsets(np.bincount(rows, minlength=len(lengths)))
+
+    def encode(self, names):
+        # ids of canonical author names, new names are added
+        ids = np.zeros(len(names), dtype=np.int32)
+        for k, name in enumerate(names):
+            author_id = self.author_id.get(name)
+            if author_id is None:
+                author_id = self.author_id[name] = len(self.names)
+                self.names.append(name)
+            ids[k] = author_id
+        return ids
+
+    def get(self, row):
+        return self.values[self.offsets[row]: self.offsets[row + 1]]
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        index = cls()
+        index.names = snapshot_utils._load_json(path, "author_names")
+        index.author_id = {name: i for i, name in enumerate(index.names)}
+        index.values = snapshot_utils._load_array(path, "authors_values", mmap_mode)
+        index.offsets = snapshot_utils._load_array(path, "authors_offsets", mmap_mode)
+        return index
+
+    def save(self, path):
+        snapshot_utils._save_json(path, "author_names", self.names)
+        snapshot_utils._save_array(path, "authors_values", self.values)
+        snapshot_utils._save_array(path, "authors_offsets", self.offsets)
+
+
+class NodeStore(object):
+    def __init__(self, ids, years):
+        # row k of every column belongs to paper ids[k]
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.years = np.asarray(years, dtype=np.int32)
+        self.row = {node_id: i for i, node_id in enumerate(self.ids.tolist())}
+        self._order = np.argsort(self.ids, kind="mergesort")
+        self._sorted_ids = self.ids[self._order]
+
+        # token fields share one vocabulary: field -> (values, offsets)
+        self.vocab = {}
+        self.words = []
+        self.tokens = {}
+
+        # authors of every paper as ids into self.authors.names
+        self.authors = AuthorIndex(len(self.ids))
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def encode_words(self, words):
+        # ids of words in the shared token vocabulary, new words are added
+        ids = []
+        for word in words:
+            word_id = self.vocab.get(word)
+            if word_id is None:
+                word_id = self.vocab[word] = len(self.words)
+                self.words.append(word)
+            ids.append(word_id)
+        return ids
+
+    def get_token_lists(self, field):
+        values, offsets = self.tokens[field]
+        return [values[offsets[k]: offsets[k + 1]].tolist() for k in range(len(self))]
+
+    def get_tokens(self, field, row):
+        values, offsets = self.tokens[field]
+        return values[offsets[row]: offsets[row + 1]]
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        # inverse of `save`, arrays are memory-mapped
+        store = cls(snapshot_utils._load_array(path, "ids", mmap_mode), snapshot_utils._load_array(path, "years"))
+        store.words = snapshot_utils._load_json(path, "words")
+        store.vocab = {word: i for i, word in enumerate(store.words)}
+        for field in snapshot_utils._load_json(path, "token_fields"):
+            store.tokens[field] = (snapshot_utils._load_array(path, "tokens_%s_values" % field, mmap_mode),
+                                   snapshot_utils._load_array(path, "tokens_%s_offsets" % field, mmap_mode))
+        store.authors = AuthorIndex.load(path, mmap_mode)
+        return store
+
+    def rows(self, ids):
+        # vectorized paper id -> row lookup
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self) - 1)
+        if not np.array_equal(self._sorted_ids[pos], ids):
+            raise KeyError("unknown paper ids: %s" % ids[self._sorted_ids[pos] != ids][:5])
+        return self._order[pos]
+
+    def save(self, path):
+        # every column as .npy in path, vocabularies as json
+        snapshot_utils._save_array(path, "ids", self.ids)
+        snapshot_utils._save_array(path, "years", self.years)
+        snapshot_utils._save_json(path, "words", self.words)
+        snapshot_utils._save_json(path, "token_fields", list(self.tokens))
+        for field, (values, offsets) in self.tokens.items():
+            snapshot_utils._save_array(path, "tokens_%s_values" % field, values)
+            snapshot_utils._save_array(path, "tokens_%s_offsets" % field, offsets)
+        self.authors.save(path)
+
+    def set_tokens(self, field, values, offsets):
+        # a tokenized column as flattened ids of self.vocab, row k is values[offsets[k]: offsets[k + 1]]
+        self.tokens[field] = (np.asarray(values, dtype=np.int32), np.asarray(offsets, dtype=np.int64))
@@ -17,4 +17,12 @@ def _try_divide(x, y, val=0.0):
     """try to divide two numbers"""
     if y != 0.0:
         val = float(x) / y
-    return val
\ No newline at end of file
+    return val
+
+def _try_divide_array(x, y, val=0.0):
+    """try to divide two arrays elementwise, `val` where y is zero"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    out = np.full(np.broadcast(x, y).shape, val, dtype=np.float64)
+    np.divide(x, y, out=out, where=y != 0.0)
+    return out
@@ -0,0 +1,71 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for sharded, multiprocess computation over forked workers
+"""
+
+import multiprocessing as mp
+import resource
+import sys
+
+sys.path.append("..")
+
+# object shared with the forked workers, inherited copy-on-write instead of pickled
+_SHARED = None
+
+
+def _n_jobs(n_jobs):
+    """-1 means all cores"""
+    if n_jobs is None or n_jobs < 1:
+        return mp.cpu_count()
+    return n_jobs
+
+
+def _chunk_bounds(n_rows, chunk_size):
+    """[(from_iloc, to_iloc), ...] covering range(n_rows) in order"""
+    chunk_size = max(int(chunk_size), 1)
+    return [(start, min(start + chunk_size, n_rows)) for start in range(0, n_rows, chunk_size)]
+
+
+def _call_shared(args):
+    method, method_args = args
+    return getattr(_SHARED, method)(*method_args)
+
+
+def _map_shared(obj, method, args_list, n_jobs=-1):
+    """obj.method(*args) for every args of args_list, in order, across forked workers sharing obj"""
+    global _SHARED
+    n_jobs = min(_n_jobs(n_jobs), len(args_list))
+    if n_jobs <= 1 or "fork" not in mp.get_all_start_methods():
+        return [getattr(obj, method)(*method_args) for method_args in args_list]
+    _SHARED = obj
+    try:
+        with mp.get_context("fork").Pool(n_jobs) as pool:
+            return pool.map(_call_shared, [(method, method_args) for method_args in args_list], chunksize=1)
+    finally:
+        _SHARED = None
+
+
+def _imap_shared(obj, method, args_list, n_jobs=-1, fresh=False):
+    """like `_map_shared`, but yields every result as soon as its worker is done (in any order); with fresh,
+    every call gets a newly forked worker so that per-process figures such as `_peak_memory` are per call"""
+    global _SHARED
+    n_jobs = min(_n_jobs(n_jobs), len(args_list))
+    if n_jobs < 1:
+        return
+    if "fork" not in mp.get_all_start_methods():
+        for method_args in args_list:
+            yield getattr(obj, method)(*method_args)
+        return
+    _SHARED = obj
+    try:
+        with mp.get_context("fork").Pool(n_jobs, maxtasksperchild=1 if fresh else None) as pool:
+            for result in pool.imap_unordered(_call_shared, [(method, method_args) for method_args in args_list],
+                                              chunksize=1):
+                yield result
+    finally:
+        _SHARED = None
+
+
+def _peak_memory():
+    """peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
@@ -0,0 +1,120 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for MinHash sketches of n-gram sets, approximate batch jaccard and an LSH banding index
+"""
+
+import sys
+
+import numpy as np
+
+from utils import graph_utils
+sys.path.append("..")
+
+# hashes are (a * gram + b) mod _PRIME, an empty set gets the signature _PRIME (no hash reaches it)
+_PRIME = (1 << 31) - 1
+
+
+def _minhash(matrix, num_perm=128, seed=0, max_cells=1 << 24):
+    """(rows x num_perm) uint32 MinHash signatures of the gram sets of a binary CSR matrix, rows are
+    processed so that about max_cells hashes are held at once"""
+    matrix = matrix.tocsr()
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+    n_rows = matrix.shape[0]
+    signatures = np.full((n_rows, num_perm), _PRIME, dtype=np.uint32)
+    indptr = matrix.indptr
+    row_sizes = np.diff(indptr)
+    start = 0
+    while start < n_rows:
+        stop = max(np.searchsorted(indptr, indptr[start] + max_cells // num_perm, side="right") - 1, start + 1)
+        stop = min(stop, n_rows)
+        grams = matrix.indices[indptr[start]: indptr[stop]].astype(np.uint64)
+        hashes = (grams[:, None] * a[None, :] + b[None, :]) % np.uint64(_PRIME)
+        filled = np.flatnonzero(row_sizes[start: stop])
+        if len(filled):
+            signatures[start + filled] = np.minimum.reduceat(hashes, indptr[start + filled] - indptr[start], axis=0)
+        start = stop
+    return signatures
+
+
+def _minhash_jaccard(signatures, rows_a, rows_b, chunk_size=100000):
+    """estimated jaccard of rows_a[k] and rows_b[k]: the share of equal signature positions, 0 if a set is empty"""
+    rows_a = np.asarray(rows_a, dtype=np.int64)
+    rows_b = np.asarray(rows_b, dtype=np.int64)
+    empty = signatures[:, 0] == _PRIME
+    out = np.zeros(len(rows_a))
+    for start in range(0, len(rows_a), chunk_size):
+        stop = start + chunk_size
+        a = rows_a[start: stop]
+        b = rows_b[start: stop]
+        out[start: stop] = (signatures[a] == signatures[b]).mean(axis=1)
+    out[empty[rows_a] | empty[rows_b]] = 0.0
+    return out
+
+
+class LSHIndex(object):
+    # banded LSH over MinHash signatures: rows whose signatures agree on all rows_per_band positions of some
+    # band share a bucket. Pairs of jaccard s collide with probability 1 - (1 - s^r)^b, the steep part of
+    # which is near `threshold`
+
+    def __init__(self, signatures, bands):
+        n_rows, num_perm = signatures.shape
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        if self.rows_per_band == 0:
+            raise ValueError("%d bands need at least as many permutations, got %d" % (bands, num_perm))
+        # one 64-bit key per (row, band), empty sets are in no bucket
+        banded = signatures[:, :bands * self.rows_per_band].reshape(n_rows, bands, self.rows_per_band)
+        keys = np.zeros((n_rows, bands), dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for k in range(self.rows_per_band):
+                keys = keys * np.uint64(1000003) + banded[:, :, k].astype(np.uint64)
+        members = np.flatnonzero(signatures[:, 0] != _PRIME)
+        # per band: the rows sorted by key and the bucket boundaries in that order
+        self.buckets = []
+        for band in range(bands):
+            order = members[np.argsort(keys[members, band], kind="mergesort")]
+            band_keys = keys[order, band]
+            starts = np.flatnonzero(np.r_[True, band_keys[1:] != band_keys[:-1]])
+            self.buckets.append((band_keys, order, np.r_[starts, len(order)]))
+        self.keys = keys
+
+    @property
+    def threshold(self):
+        return (1.0 / self.bands) ** (1.0 / self.rows_per_band)
+
+    def candidate_pairs(self, max_bucket_size=100, seed=0):
+        """(row a, row b) with a < b of every pair sharing a bucket in some band. Buckets larger than
+        max_bucket_size (short or boilerplate texts) only pair a random max_bucket_size of their rows, which
+        keeps the pairs of a bucket bounded; None pairs every bucket in full"""
+        rng = np.random.RandomState(seed)
+        pairs = []
+        for _, order, bounds in self.buckets:
+            sizes = np.diff(bounds)
+            if max_bucket_size is not None and len(order) and sizes.max() > max_bucket_size:
+                # rows in random order within their bucket, the first max_bucket_size of each are kept
+                bucket = np.repeat(np.arange(len(sizes)), sizes)
+                shuffled = np.lexsort((rng.random_sample(len(order)), bucket))
+                keep = np.arange(len(order)) - bounds[:-1][bucket] < max_bucket_size
+                order = order[shuffled][keep]
+                sizes = np.minimum(sizes, max_bucket_size)
+                bounds = np.r_[0, np.cumsum(sizes)]
+            buckets = np.flatnonzero(sizes > 1)
+            _, a, b = graph_utils._cartesian_pairs(order, bounds, buckets, buckets)
+            keep = a < b
+            pairs.append(np.column_stack([a[keep], b[keep]]))
+        if not pairs:
+            return np.zeros((0, 2), dtype=np.int64)
+        return np.unique(np.concatenate(pairs, axis=0), axis=0)
+
+    def query(self, row):
+        """rows sharing a bucket with row in some band"""
+        matches = []
+        for band, (band_keys, order, bounds) in enumerate(self.buckets):
+            key = self.keys[row, band]
+            lo = np.searchsorted(band_keys, key, side="left")
+            hi = np.searchsorted(band_keys, key, side="right")
+            matches.append(order[lo: hi])
+        matches = np.unique(np.concatenate(matches)) if matches else np.zeros(0, dtype=np.int64)
+        return matches[matches != row]
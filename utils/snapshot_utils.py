@@ -0,0 +1,70 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for versioned on-disk snapshots of prepared arrays, memory-mapped on load
+"""
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+from scipy import sparse
+
+sys.path.append("..")
+
+
+def _array_file(path, name):
+    return os.path.join(path, "%s.npy" % name)
+
+
+def _save_array(path, name, array):
+    np.save(_array_file(path, name), np.asarray(array))
+
+
+def _load_array(path, name, mmap_mode="r"):
+    return np.load(_array_file(path, name), mmap_mode=mmap_mode)
+
+
+def _save_csr(path, name, matrix):
+    matrix = matrix.tocsr()
+    _save_array(path, name + "_data", matrix.data)
+    _save_array(path, name + "_indices", matrix.indices)
+    _save_array(path, name + "_indptr", matrix.indptr)
+    _save_json(path, name + "_shape", list(matrix.shape))
+
+
+def _load_csr(path, name, mmap_mode="r"):
+    shape = tuple(_load_json(path, name + "_shape"))
+    return sparse.csr_matrix((_load_array(path, name + "_data", mmap_mode),
+                              _load_array(path, name + "_indices", mmap_mode),
+                              _load_array(path, name + "_indptr", mmap_mode)), shape=shape, copy=False)
+
+
+def _save_json(path, name, obj):
+    with open(os.path.join(path, "%s.json" % name), "w") as f:
+        json.dump(obj, f)
+
+
+def _load_json(path, name):
+    with open(os.path.join(path, "%s.json" % name), "r") as f:
+        return json.load(f)
+
+
+def _is_valid(path, meta):
+    """does the snapshot in path exist and was it written with exactly `meta` (versions, input hashes)"""
+    try:
+        return _load_json(path, "meta") == meta
+    except (IOError, ValueError):
+        return False
+
+
+def _start(path):
+    """empty the snapshot directory before writing; the meta file is written last by `_finish`"""
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+
+def _finish(path, meta):
+    _save_json(path, "meta", meta)
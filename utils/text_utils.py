@@ -0,0 +1,54 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for tokenizing text columns into flattened token-id arrays
+"""
+
+import itertools
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append("..")
+
+# one pass over an author field: drop bracketed affiliations, whitespace, escaped quotes and braces, cut at an
+# unclosed "(" and turn "&" into a separator. A bracket pair never spans a line, the unclosed cut runs to the end
+_AUTHOR_NOISE = re.compile(r'\([^\n]*?\)|\s|\\""\{|\\""\{\\|\\\\\'|\\\'|\\""|\\"|\\|\}|\'|\([\s\S]*|(&)')
+
+
+def _offsets(lengths):
+    """row offsets of a flattened column from its row lengths"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return offsets
+
+
+def _tokenize(texts, encode):
+    """lowercase and split every text on " " in one pass, encode(distinct words) -> their ids;
+    returns the flattened (token ids, offsets)"""
+    tokens = pd.Series(texts, dtype=object).fillna("").str.lower().str.split(" ")
+    lengths = tokens.str.len().values.astype(np.int64)
+    flat = np.fromiter(itertools.chain.from_iterable(tokens.values), dtype=object, count=lengths.sum())
+    codes, uniques = pd.factorize(flat)
+    ids = np.asarray(encode(list(uniques)), dtype=np.int32)
+    return ids[codes], _offsets(lengths)
+
+
+def _filter_tokens(values, offsets, keep):
+    """drop the tokens whose id is not kept, keep is a boolean array over token ids"""
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    mask = keep[values]
+    return values[mask], _offsets(np.bincount(rows[mask], minlength=len(offsets) - 1))
+
+
+def _map_tokens(values, offsets, mapping):
+    """replace every token id by mapping[id], mapping is an int array over token ids"""
+    return mapping[values].astype(np.int32), offsets
+
+
+def _split_authors(texts):
+    """canonical author names of every author field as a list, NaN for a missing field"""
+    cleaned = pd.Series(texts, dtype=object).str.replace(
+        _AUTHOR_NOISE, lambda m: "," if m.group(1) else "", regex=True)
+    return cleaned.str.lower().str.split(",")
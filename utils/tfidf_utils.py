@@ -0,0 +1,49 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for tf-idf vectors of token-id columns and batch cosine similarity
+"""
+
+import sys
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfTransformer
+
+from utils import np_utils
+sys.path.append("..")
+
+
+def _counts(values, offsets, n_terms):
+    """CSR term counts (rows x terms) of a flattened (values, offsets) token-id column"""
+    matrix = sparse.csr_matrix((np.ones(len(values)), np.asarray(values, dtype=np.int64),
+                                np.asarray(offsets, dtype=np.int64)), shape=(len(offsets) - 1, n_terms))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def _tfidf(values, offsets, n_terms):
+    """L2-normalized tf-idf rows of a token-id column, idf fitted on all its rows as TfidfVectorizer does"""
+    return TfidfTransformer(norm="l2").fit_transform(_counts(values, offsets, n_terms)).tocsr()
+
+
+def _svd(matrix, n_components, seed=0):
+    """dense L2-normalized truncated-SVD vectors of the rows of matrix, all-zero rows stay zero"""
+    n_components = min(n_components, matrix.shape[1] - 1)
+    vectors = TruncatedSVD(n_components=n_components, random_state=seed).fit_transform(matrix)
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    return (vectors * np_utils._try_divide_array(1.0, norms)[:, None]).astype(np.float32)
+
+
+def _batch_cosine(vectors, rows_a, rows_b, chunk_size=100000):
+    """cosine of rows_a[k] and rows_b[k] of L2-normalized vectors (sparse or dense), computed chunk by chunk"""
+    out = np.zeros(len(rows_a))
+    for start in range(0, len(rows_a), chunk_size):
+        stop = start + chunk_size
+        a = vectors[rows_a[start: stop]]
+        b = vectors[rows_b[start: stop]]
+        if sparse.issparse(vectors):
+            out[start: stop] = np.asarray(a.multiply(b).sum(axis=1)).ravel()
+        else:
+            out[start: stop] = np.einsum("ij,ij->i", a, b)
+    return out
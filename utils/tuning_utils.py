@@ -0,0 +1,155 @@
+"""
+@author: Fangshu Gao <gaofangshu@foxmail.com>
+@brief: utils for xgboost hyperparameter search by successive halving, with a resumable trial log
+"""
+
+import hashlib
+import itertools
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import xgboost as xgb
+from sklearn.metrics import f1_score
+from sklearn.model_selection import StratifiedKFold
+
+sys.path.append("..")
+
+
+def _param_grid(cv_params):
+    """every point of the grid {name: [values]} as a dict, in the order of GridSearchCV (names sorted, the
+    last name varying fastest)"""
+    names = sorted(cv_params)
+    return [dict(zip(names, values)) for values in itertools.product(*[cv_params[name] for name in names])]
+
+
+def _budgets(eta, min_fraction):
+    """resource fractions of the rungs, smallest first: 1 / eta^k down to min_fraction"""
+    n_rungs = int(math.floor(math.log(1.0 / min_fraction, eta) + 1e-9)) + 1
+    return [float(eta) ** (k - n_rungs + 1) for k in range(n_rungs)]
+
+
+class SuccessiveHalving(object):
+    # grid search over an xgboost classifier that scores every point on a small budget (boosting rounds or
+    # training rows) and gives eta times the budget to the best 1 / eta of them only, rung by rung, until the
+    # survivors run on the full budget. The rows are sorted by content first, so the folds, the scores and the
+    # log key do not depend on the row order the data comes in. At the full budget a point's score is its
+    # cross-validated f1 exactly as GridSearchCV(scoring="f1", cv=n_folds) gets it on the sorted rows; every
+    # point is fitted from scratch on its rung's budget, so scores do not depend on which rungs ran in an
+    # earlier, interrupted search. The best point of the grid can drop out on a small budget, so the search may
+    # pick other parameters than GridSearchCV would.
+    # The fold DMatrices are built once and shared by every trial. Every finished trial is appended to a
+    # json-lines log under path keyed by the data and the search settings, and a restarted search reads it
+    # back instead of fitting again
+    RESOURCES = ("rounds", "rows")
+
+    def __init__(self, other_params, cv_params, X, y, n_folds=5, eta=3, min_fraction=1.0 / 9, resource="rounds",
+                 path="tuning", seed=0):
+        # other_params: XGBClassifier parameters of every trial, cv_params: {name: [values]} of the grid;
+        # resource: budget of a rung, "rounds" scales n_estimators, "rows" the training rows of every fold
+        if resource not in self.RESOURCES:
+            raise KeyError("unknown resource %s, expected one of %s" % (resource, ", ".join(self.RESOURCES)))
+        self.other_params = other_params
+        self.grid = _param_grid(cv_params)
+        X = np.asarray(X)
+        y = np.asarray(y)
+        order = np.lexsort(np.column_stack([X, y]).T[::-1])
+        self.X = X[order]
+        self.y = y[order]
+        self.n_folds = n_folds
+        self.eta = eta
+        self.budgets = _budgets(eta, min_fraction)
+        self.resource = resource
+        self.path = path
+        self.seed = seed
+        self.folds = list(StratifiedKFold(n_splits=n_folds).split(self.X, self.y))
+        self.dtrains = [xgb.DMatrix(self.X[train_idx], label=self.y[train_idx]) for train_idx, _ in self.folds]
+        self.dvalids = [xgb.DMatrix(self.X[valid_idx]) for _, valid_idx in self.folds]
+        # row subsets of the training folds for resource "rows", nested across rungs
+        self.row_orders = [np.random.RandomState(seed + j).permutation(len(train_idx))
+                           for j, (train_idx, _) in enumerate(self.folds)]
+        self.row_slices = {}
+        self.log_file = os.path.join(path, "trials_%s.jsonl" % self.get_key())
+        self.trials = self.read_log()
+
+    def get_key(self):
+        # the data, the fold split and every search setting a logged score depends on
+        md5 = hashlib.md5()
+        for matrix in (self.X, self.y):
+            md5.update(str(matrix.shape).encode())
+            md5.update(np.ascontiguousarray(matrix).tobytes())
+        md5.update(json.dumps([sorted(self.other_params.items()), self.n_folds, self.resource, self.seed],
+                              default=str).encode())
+        return md5.hexdigest()
+
+    def get_train(self, j, fraction):
+        if self.resource == "rounds" or fraction >= 1:
+            return self.dtrains[j]
+        if (j, fraction) not in self.row_slices:
+            n_rows = max(int(round(len(self.row_orders[j]) * fraction)), 1)
+            self.row_slices[(j, fraction)] = self.dtrains[j].slice(np.sort(self.row_orders[j][:n_rows]))
+        return self.row_slices[(j, fraction)]
+
+    def get_trial_key(self, params, fraction):
+        return json.dumps([sorted(params.items()), round(fraction, 10)], default=str)
+
+    def read_log(self):
+        trials = {}
+        if os.path.exists(self.log_file):
+            with open(self.log_file, "r") as f:
+                for line in f:
+                    # a line cut off by an interruption is dropped and its trial run again
+                    try:
+                        trial = json.loads(line)
+                    except ValueError:
+                        continue
+                    trials[self.get_trial_key(trial["params"], trial["fraction"])] = trial
+        return trials
+
+    def write_log(self, trial):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(self.log_file, "a") as f:
+            f.write(json.dumps(trial, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def evaluate(self, params, fraction):
+        """mean f1 over the folds of the grid point params on a fraction of the budget, from the log if there"""
+        key = self.get_trial_key(params, fraction)
+        if key in self.trials:
+            return self.trials[key]["score"]
+        t0 = time.time()
+        clf_params = dict(self.other_params, **params)
+        n_rounds = clf_params.pop("n_estimators", 100)
+        if self.resource == "rounds":
+            n_rounds = max(int(round(n_rounds * fraction)), 1)
+        # native parameters as XGBClassifier.fit passes them to xgb.train
+        xgb_params = xgb.XGBClassifier(**clf_params).get_xgb_params()
+        fold_scores = []
+        for j, (_, valid_idx) in enumerate(self.folds):
+            booster = xgb.train(xgb_params, self.get_train(j, fraction), num_boost_round=n_rounds)
+            fold_scores.append(f1_score(self.y[valid_idx], booster.predict(self.dvalids[j]) > 0.5))
+        trial = {"params": params, "fraction": fraction, "n_rounds": n_rounds, "score": float(np.mean(fold_scores)),
+                 "fold_scores": [float(score) for score in fold_scores], "seconds": time.time() - t0}
+        self.write_log(trial)
+        self.trials[key] = trial
+        return trial["score"]
+
+    def run(self, verbose=True):
+        """(best params, best score) of the grid; trials of every rung are in self.trials"""
+        survivors = list(self.grid)
+        for rung, fraction in enumerate(self.budgets):
+            t0 = time.time()
+            scores = np.array([self.evaluate(params, fraction) for params in survivors])
+            # best first, ties to the earlier grid point as GridSearchCV's best_params_
+            order = np.argsort(-scores, kind="mergesort")
+            if verbose:
+                print("rung %d: %d points on %.4f of the budget, best score %.10f, %.2f sec"
+                      % (rung, len(survivors), fraction, scores[order[0]], time.time() - t0))
+            if fraction >= 1:
+                return survivors[order[0]], float(scores[order[0]])
+            survivors = [survivors[k] for k in order[:max(int(math.ceil(len(survivors) / float(self.eta))), 1)]]